@@ -5,16 +5,43 @@
     Date last modified: 27/01/2025
     Python Version: 3.3
 '''
+import argparse
+import atexit
+import hashlib
+import heapq
+import multiprocessing
+import os
+import pickle
 import pygame
+import queue
 import random
+import struct
 import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Constants
 SCREEN_WIDTH = 1200
 SCREEN_HEIGHT = 600
 TILE_SIZE = 32
-GRID_WIDTH = SCREEN_WIDTH // TILE_SIZE
-GRID_HEIGHT = SCREEN_HEIGHT // TILE_SIZE
+VIEW_WIDTH = SCREEN_WIDTH // TILE_SIZE
+VIEW_HEIGHT = SCREEN_HEIGHT // TILE_SIZE
+# Dungeon size in tiles, the camera scrolls when it exceeds the view
+GRID_WIDTH = VIEW_WIDTH
+GRID_HEIGHT = VIEW_HEIGHT
+# Sight radius of the player in tiles
+FOV_RADIUS = 5
+# Push only changed screen regions instead of flipping the whole frame
+DIRTY_RECT_RENDERING = False
+# Animations advance at a fixed rate, independent of the render rate
+ANIMATION_TICK_RATE = 15
+RENDER_FPS = 60
+MAX_TICKS_PER_FRAME = 4
 POTION_WEIGHTS = {
     "small": 60,
     "medium": 30,
@@ -26,6 +53,14 @@ BASE_ENEMY_HEALTH_MULTIPLIER = 1
 BASE_ENEMY_DAMAGE_INCREMENT = 1
 MIN_ENEMY_DAMAGE = 1
 
+# Fewest steps between the player's starting tile and a spawned enemy
+SAFE_SPAWN_DISTANCE = 8
+
+# Walking distance from the player within which enemies path around
+# walls, in wake radii, further away they step straight towards the
+# player. Two reach every awake enemy with a straight walk to the player.
+FLOW_FIELD_WAKE_RADII = 2
+
 # Colors
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
@@ -34,15 +69,88 @@ RED = (255, 0, 0)
 GRAY = (100, 100, 100)
 DARK_GRAY = (50, 50, 50)
 BLUE = (0, 0, 255)
+REMEMBERED_TILE_SHADE = (140, 140, 140)
+
+# Screen, opened by init_display()
+screen = None
+headless = False
+
+
+# Opening the game window, or only the dummy video driver when headless
+def init_display(headless_mode=False):
+    global screen, headless, font, options_font
+    headless = headless_mode
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.display.init()
+        return
+
+    pygame.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("Rogue-like Game")
+    load_tiles()
+    atexit.register(assets.save)
+    level_prefetcher.start()
+    font = load_font(32)
+    options_font = load_font(48)
 
-# Initialize screen
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Rogue-like Game")
 
 # Clock for controlling frame rate
 clock = pygame.time.Clock()
 
+
+# Blocking until at least one event arrives, then draining the queue
+def wait_for_events():
+    events = [pygame.event.wait()]
+    events.extend(pygame.event.get())
+    return events
+
+
 FONT_PATH = "MinimalPixelFont.ttf"
+TEXT_CACHE_SIZE = 256
+
+# Loaded fonts, keyed by point size
+fonts = {}
+
+
+# Loading a font once per size so cached text can be reused
+def load_font(size):
+    if size not in fonts:
+        fonts[size] = pygame.font.Font(FONT_PATH, size)
+    return fonts[size]
+
+
+# Bounded LRU cache of rendered text surfaces
+class TextCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+text_cache = TextCache(TEXT_CACHE_SIZE)
+
+
+# Rendering a string through the text cache
+def render_text(font, text, color):
+    return text_cache.render(font, text, color)
+
 
 # Player animation states
 player_animation_state = "idle"  # "idle", "attacking", "damaged"
@@ -60,6 +168,10 @@ xp_for_next_level = 10
 current_level = 1
 stat_points = 0
 
+# Seed of the current run, every level and loot roll derives from it
+run_seed = 0
+loot_rng = random.Random()
+
 # Player Stats
 strength = 1
 vitality = 1
@@ -67,8 +179,9 @@ vitality = 1
 # Log
 log = []
 
-# Visibility
-visibility = [[False for _ in range(GRID_WIDTH)] for _ in range(GRID_HEIGHT)]
+# Visibility, the field of view and the explored cells it has revealed
+fov = None
+visibility = None
 
 # Base Enemy Types
 ENEMY_TYPES = {
@@ -77,163 +190,482 @@ ENEMY_TYPES = {
     "warg": {"health": 100, "damage": 15, "speed": 2, "color": (128, 0, 128)}
 }
 
-# Load sprites
-player_sprite = pygame.image.load("frame1.png").convert_alpha()
-player_sprite = pygame.transform.scale(player_sprite, (96, 96))
-attack_right_sprites = [
-    pygame.transform.scale(pygame.image.load(
-        f"./playerattackr/attackright{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 5)
-]
-
-# Load player damage animation frames
-player_damage_frames = [
-    pygame.transform.scale(pygame.image.load(
-        f"./playerdmg/playerdmg{i}.png").
-                           convert_alpha(), (96, 96))
-    for i in range(1, 5)
-]
-
-# Load empty armor sprites
-empty_helmet = pygame.image.load("emptyarmor/emptyhelmet.png").convert_alpha()
-empty_chestplate = (pygame.image.load
-                    ("emptyarmor/emptychestplate.png").convert_alpha())
-empty_leggings = (pygame.image.load
-                  ("emptyarmor/emptylegings.png").convert_alpha())
-empty_boots = pygame.image.load("emptyarmor/emptyboots.png").convert_alpha()
-
-# Scale the sprites to fit the UI
-empty_helmet = pygame.transform.scale(empty_helmet, (32, 32))
-empty_chestplate = pygame.transform.scale(empty_chestplate, (32, 32))
-empty_leggings = pygame.transform.scale(empty_leggings, (32, 32))
-empty_boots = pygame.transform.scale(empty_boots, (32, 32))
-
-# Wall tileset
-wall_tileset = pygame.image.load(f"wall4bit.png").convert_alpha()
-wall_tileset = pygame.transform.scale(wall_tileset, (TILE_SIZE, TILE_SIZE))
-
-# Floor tileset
-floor_tileset = pygame.image.load("tileset/floor1.png").convert_alpha()
-floor_tileset = pygame.transform.scale(floor_tileset, (TILE_SIZE, TILE_SIZE))
-
-# Chest sprites
-closed_chest = (pygame.image.load
-                ("tileset/chest/clossedchest.png").convert_alpha())
-closed_chest = pygame.transform.scale(closed_chest, (TILE_SIZE, TILE_SIZE))
-open_chest = pygame.image.load("tileset/chest/openchest.png").convert_alpha()
-open_chest = pygame.transform.scale(open_chest, (TILE_SIZE, TILE_SIZE))
-
-# Stair sprite
-stair_tileset = pygame.image.load("tileset/floor_stairs.png").convert_alpha()
-stair_tileset = pygame.transform.scale(stair_tileset, (TILE_SIZE, TILE_SIZE))
-
-# Enemy sprites
-goblin_sprite = pygame.image.load("enemies/Goblin1.png").convert_alpha()
-goblin_sprite = pygame.transform.scale(goblin_sprite, (96, 96))
-goblin_attack_sprites = [
-    pygame.transform.scale(pygame.image.load
-                           (f"./goblinattack/goblinattack{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 5)
-]
-
-slime_sprite = pygame.image.load("enemies/Slime1.png").convert_alpha()
-slime_sprite = pygame.transform.scale(slime_sprite, (96, 96))
-slime_attack_sprites = [
-    pygame.transform.scale(pygame.image.load
-                           (f"./slimeattack/slimeattack{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 5)
-]
-
-# Death animations
-slime_death_frames = [
-    pygame.transform.scale(pygame.image.load
-                           (f"./slimedead/slimedie{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 10)
-]
-
-goblin_death_frames = [
-    pygame.transform.scale(pygame.image.load
-                           (f"./goblindead/goblindie{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 13)
-]
-
-# Loading goblin damage animation frames
-goblin_damage_frames = [
-    pygame.transform.scale(pygame.image.load
-                           (f"./goblindmg/goblindmg{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 5)
-]
-
-# Loading Warg sprites
-warg_sprite = pygame.image.load("enemies/warg.png").convert_alpha()
-warg_sprite = pygame.transform.scale(warg_sprite, (96, 96))
-
-warg_attack_sprites = [
-    pygame.transform.scale(pygame.image.load(f"./wargattack"
-                                             f"/wargattack{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 5)
-]
-
-warg_damage_frames = [
-    pygame.transform.scale(pygame.image.load(f"./wargdamage/"
-                                             f"wargdamage{i}.png")
-                           .convert_alpha(), (96, 96))
-    for i in range(1, 5)
-]
-
-# Potion sprites
-small_potion_sprite = (pygame.image.load
-                       ("potions/smallpotion.png").convert_alpha())
-small_potion_sprite = (pygame.transform.scale
-                       (small_potion_sprite, (TILE_SIZE, TILE_SIZE)))
-medium_potion_sprite = (pygame.image.load
-                        ("potions/mediumpotion.png").convert_alpha())
-medium_potion_sprite = (pygame.transform.scale
-                        (medium_potion_sprite, (TILE_SIZE, TILE_SIZE)))
-large_potion_sprite = (pygame.image.load
-                       ("potions/largepotion.png").convert_alpha())
-large_potion_sprite = (pygame.transform.scale
-                       (large_potion_sprite, (TILE_SIZE, TILE_SIZE)))
-
-potion_sprites = {
-    "small": small_potion_sprite,
-    "medium": medium_potion_sprite,
-    "large": large_potion_sprite,
+# Enemy kinds and animation states as small integers, with their names
+GOBLIN, SLIME, WARG = range(3)
+ENEMY_KINDS = ["goblin", "slime", "warg"]
+ALIVE, ATTACKING, DAMAGED, DYING = range(4)
+ENEMY_STATES = ["alive", "attacking", "damaged", "dying"]
+
+
+# An enemy, kept small with slots since a level may hold thousands
+class Enemy:
+    __slots__ = ("x", "y", "kind", "state", "current_frame",
+                 "frame_counter", "health", "damage", "facing")
+
+    def __init__(self, kind, x, y, health, damage):
+        self.x = x
+        self.y = y
+        self.kind = kind
+        self.state = ALIVE
+        self.current_frame = 0
+        self.frame_counter = 0
+        self.health = health
+        self.damage = damage
+        self.facing = "right"
+
+    @property
+    def name(self):
+        return ENEMY_KINDS[self.kind]
+
+
+# Enemies whose animation state is anything but ALIVE
+animating_enemies = set()
+
+# Game time taken by one player turn. An enemy's action takes this much
+# divided by its speed, so a speed 2 enemy acts twice per player turn.
+TURN_TIME = 12
+ENEMY_ACTION_TIMES = [TURN_TIME // ENEMY_TYPES[name]["speed"]
+                      for name in ENEMY_KINDS]
+
+
+# Enemies queued by the game time of their next action. Each action is
+# a heap pop and push, and killed enemies are dropped when they come up.
+class TurnScheduler:
+    def __init__(self):
+        self.queue = []
+        self.now = 0
+        self.order = 0
+
+    def reset(self, actors):
+        self.queue = []
+        self.now = 0
+        for actor in actors:
+            self.add(actor, 0)
+
+    def add(self, actor, delay):
+        # The running order breaks ties, so equal times keep their order
+        self.order += 1
+        heapq.heappush(self.queue, (self.now + delay, self.order, actor))
+
+    # Every actor due at the earliest time before the given one, in queue
+    # order, or an empty list
+    def next_group(self, time):
+        if not self.queue or self.queue[0][0] >= time:
+            self.now = time
+            return []
+        self.now = self.queue[0][0]
+        group = []
+        while self.queue and self.queue[0][0] == self.now:
+            group.append(heapq.heappop(self.queue)[2])
+        return group
+
+
+turn_scheduler = TurnScheduler()
+
+# Enemies further than this many tiles from the player along either axis,
+# or on tiles the player has not explored, sleep and take no turns
+ENEMY_WAKE_RADIUS = 12
+# Side in tiles of the squares sleeping enemies are filed under
+DORMANT_CELL_SIZE = 8
+
+
+# Sleeping enemies, filed by square and then by tile, so that waking them
+# only looks at the squares around the player. Sleepers never move, so
+# their tiles stay valid keys.
+class DormantEnemies:
+    def __init__(self):
+        self.cells = {}
+
+    def reset(self, actors):
+        self.cells = {}
+        for actor in actors:
+            self.add(actor)
+
+    def add(self, actor):
+        key = (actor.x // DORMANT_CELL_SIZE, actor.y // DORMANT_CELL_SIZE)
+        self.cells.setdefault(key, {})[actor.x, actor.y] = actor
+
+    def discard(self, actor):
+        cell = self.cells.get((actor.x // DORMANT_CELL_SIZE,
+                               actor.y // DORMANT_CELL_SIZE))
+        if cell is not None and cell.get((actor.x, actor.y)) is actor:
+            del cell[actor.x, actor.y]
+
+    # Taking out the sleepers within radius of (x, y) that stand on tiles
+    # of the explored grid that are set, in a fixed order
+    def wake(self, x, y, radius, explored):
+        woken = []
+        # Squares off the map hold nobody, however large the radius
+        first_x = max(0, x - radius) // DORMANT_CELL_SIZE
+        last_x = min(explored.width - 1, x + radius) // DORMANT_CELL_SIZE
+        first_y = max(0, y - radius) // DORMANT_CELL_SIZE
+        last_y = min(explored.height - 1, y + radius) // DORMANT_CELL_SIZE
+        for cell_y in range(first_y, last_y + 1):
+            for cell_x in range(first_x, last_x + 1):
+                cell = self.cells.get((cell_x, cell_y))
+                if not cell:
+                    continue
+                for pos, actor in list(cell.items()):
+                    if (abs(pos[0] - x) <= radius and abs(pos[1] - y) <= radius
+                            and explored[pos]):
+                        del cell[pos]
+                        woken.append(actor)
+        return woken
+
+
+dormant_enemies = DormantEnemies()
+
+# Asset cache with scaled pixel data, reused while source mtimes match
+ASSET_CACHE_PATH = "assets.cache"
+ASSET_CACHE_VERSION = 1
+
+
+# Loads images on first use and keeps their scaled pixels on disk
+class AssetManager:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.images = {}
+        self.cache = None
+        self.cache_dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def read_cache(self):
+        self.cache = {}
+        try:
+            with open(self.cache_path, "rb") as f:
+                version, images = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return
+        if version == ASSET_CACHE_VERSION:
+            self.cache = images
+
+    def image(self, path, size, alpha=True):
+        key = (path, size, alpha)
+        surface = self.images.get(key)
+        if surface is None:
+            surface = self.load(key)
+            self.images[key] = surface
+        return surface
+
+    def load(self, key):
+        path, size, alpha = key
+        if self.cache is None:
+            self.read_cache()
+
+        mode = "RGBA" if alpha else "RGB"
+        mtime = os.path.getmtime(path)
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] == mtime:
+            self.hits += 1
+            surface = pygame.image.frombuffer(entry[1], size, mode)
+        else:
+            self.misses += 1
+            surface = pygame.transform.scale(pygame.image.load(path), size)
+            self.cache[key] = (mtime, pygame.image.tobytes(surface, mode))
+            self.cache_dirty = True
+        return surface.convert_alpha() if alpha else surface.convert()
+
+    def save(self):
+        if not self.cache_dirty:
+            return
+        temp_path = self.cache_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                pickle.dump((ASSET_CACHE_VERSION, self.cache), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            return
+        self.cache_dirty = False
+
+
+assets = AssetManager(ASSET_CACHE_PATH)
+
+
+# Loading an image scaled to the given size, through the asset cache
+def load_image(path, size, alpha=True):
+    return assets.image(path, size, alpha)
+
+
+# Animation frames on disk, keyed by (entity type, animation state)
+SPRITE_ANIMATIONS = {
+    ("player", "idle"): ["frame1.png"],
+    ("player", "attacking"): [f"playerattackr/attackright{i}.png"
+                              for i in range(1, 5)],
+    ("player", "damaged"): [f"playerdmg/playerdmg{i}.png"
+                            for i in range(1, 5)],
+    ("goblin", "alive"): ["enemies/Goblin1.png"],
+    ("goblin", "attacking"): [f"goblinattack/goblinattack{i}.png"
+                              for i in range(1, 5)],
+    ("goblin", "damaged"): [f"goblindmg/goblindmg{i}.png"
+                            for i in range(1, 5)],
+    ("goblin", "dying"): [f"goblindead/goblindie{i}.png"
+                          for i in range(1, 13)],
+    ("slime", "alive"): ["enemies/Slime1.png"],
+    ("slime", "attacking"): [f"slimeattack/slimeattack{i}.png"
+                             for i in range(1, 5)],
+    ("slime", "dying"): [f"slimedead/slimedie{i}.png"
+                         for i in range(1, 10)],
+    ("warg", "alive"): ["enemies/warg.png"],
+    ("warg", "attacking"): [f"wargattack/wargattack{i}.png"
+                            for i in range(1, 5)],
+    ("warg", "damaged"): [f"wargdamage/wargdamage{i}.png"
+                          for i in range(1, 5)],
+    ("chest", "closed"): ["tileset/chest/clossedchest.png"],
+    ("chest", "open"): ["tileset/chest/openchest.png"],
 }
+SPRITE_SIZE = 96
+SPRITE_SIZES = {"chest": TILE_SIZE}
+
+# Animation lengths are known without loading any image, so the game
+# logic runs the same with or without sprites
+animation_lengths = {key: len(files)
+                     for key, files in SPRITE_ANIMATIONS.items()}
+# The same for enemies, indexed by enemy kind and then animation state
+enemy_animation_lengths = [[animation_lengths.get((name, state), 0)
+                            for state in ENEMY_STATES]
+                           for name in ENEMY_KINDS]
+
+
+# Sprite atlas with both facings of every animation frame, keyed by
+# (entity type, animation state, frame, facing). An entity's frames are
+# loaded the first time one of them is looked up.
+class SpriteAtlas(dict):
+    def __init__(self):
+        super().__init__()
+        self.loaded_entities = set()
+
+    def __missing__(self, key):
+        entity = key[0]
+        if entity in self.loaded_entities:
+            raise KeyError(key)
+        self.loaded_entities.add(entity)
+
+        size = SPRITE_SIZES.get(entity, SPRITE_SIZE)
+        for (name, state), files in SPRITE_ANIMATIONS.items():
+            if name == entity:
+                register_sprites(name, state,
+                                 [load_image(path, (size, size))
+                                  for path in files])
+        return self[key]
+
+
+sprite_atlas = SpriteAtlas()
+
+
+# Registering an animation together with its mirrored frames
+def register_sprites(entity, state, frames):
+    for i, frame in enumerate(frames):
+        sprite_atlas[(entity, state, i, "right")] = frame
+        sprite_atlas[(entity, state, i, "left")] = (pygame.transform.flip
+                                                    (frame, True, False))
+
+
+# Loading the map tiles, everything else is loaded on first use
+def load_tiles():
+    global wall_tileset, floor_tileset, stair_tileset
+
+    tile = (TILE_SIZE, TILE_SIZE)
+    wall_tileset = load_image("wall4bit.png", tile)
+    floor_tileset = load_image("tileset/floor1.png", tile)
+    stair_tileset = load_image("tileset/floor_stairs.png", tile)
+
 
 # Sprite offset
 SPRITE_OFFSET_X = (96 - TILE_SIZE) // 2
 SPRITE_OFFSET_Y = (96 - TILE_SIZE) // 2
 
 
+# Tile grid storing one byte per cell in row-major order,
+# indexed as grid[x, y]
+class TileGrid:
+    def __init__(self, width, height, fill=0):
+        self.width = width
+        self.height = height
+        self.cells = bytearray([fill]) * (width * height)
+
+    def __getitem__(self, pos):
+        return self.cells[pos[1] * self.width + pos[0]]
+
+    def __setitem__(self, pos, value):
+        self.cells[pos[1] * self.width + pos[0]] = value
+
+    def fill_rect(self, x, y, w, h, value):
+        first = y * self.width + x
+        end = (y + h) * self.width
+        # One slice assignment per row, or per column for tall shapes
+        if w < h:
+            column = bytes([value]) * h
+            for start in range(first, first + w):
+                self.cells[start:end:self.width] = column
+        else:
+            row = bytes([value]) * w
+            for start in range(first, end, self.width):
+                self.cells[start:start + w] = row
+
+    def rect_contains(self, x, y, w, h, value):
+        cells = self.cells
+        for start in range(y * self.width + x, (y + h) * self.width,
+                           self.width):
+            if cells.find(value, start, start + w) != -1:
+                return True
+        return False
+
+
+# Bit grid storing one bit per cell, used for fog of war
+class BitGrid:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.bits = bytearray((width * height + 7) // 8)
+
+    def __getitem__(self, pos):
+        i = pos[1] * self.width + pos[0]
+        return self.bits[i >> 3] >> (i & 7) & 1
+
+    def clear(self):
+        self.bits[:] = bytes(len(self.bits))
+
+
+# Each byte value as its eight bits, lowest first as BitGrid stores them,
+# one 0 or 1 byte per bit, and the other way round
+BIT_BYTES = [bytes(v >> k & 1 for k in range(8)) for v in range(256)]
+BITS_BYTE = {bits: v for v, bits in enumerate(BIT_BYTES)}
+
+
+# Packing bytes of 0 or 1 eight to a byte
+def pack_bits(mask):
+    mask = bytes(mask) + bytes(-len(mask) % 8)
+    return bytes(map(BITS_BYTE.__getitem__,
+                     [mask[i:i + 8] for i in range(0, len(mask), 8)]))
+
+
+# Unpacking the first count bits into bytes of 0 or 1
+def unpack_bits(bits, count):
+    return b"".join(map(BIT_BYTES.__getitem__, bits))[:count]
+
+
+# Octant transforms for shadowcasting, as (xx, xy, yx, yy)
+FOV_OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)]
+
+
+# Field of view using recursive shadowcasting. Cells visible right now
+# are kept apart from every cell explored so far, and each update
+# reports the cells whose visibility changed.
+class FieldOfView:
+    def __init__(self, width, height, radius):
+        self.width = width
+        self.height = height
+        self.radius = radius
+        self.explored = BitGrid(width, height)
+        self.visible = set()
+        self.origin = None
+
+        # Cells of each scan row with their slopes, the same in every octant
+        radius_squared = radius * radius + radius
+        self.rows = [[]]
+        for j in range(1, radius + 1):
+            dy = -j
+            self.rows.append([(dx, (dx - 0.5) / (dy + 0.5),
+                               (dx + 0.5) / (dy - 0.5),
+                               dx * dx + dy * dy <= radius_squared)
+                              for dx in range(-j, 1)])
+
+    # Forgetting everything seen, for a new level of the same size
+    def reset(self):
+        self.explored.clear()
+        self.visible = set()
+        self.origin = None
+
+    def is_visible(self, x, y):
+        return y * self.width + x in self.visible
+
+    def update(self, tiles, x, y):
+        if self.origin == (x, y):
+            return set()
+        self.origin = (x, y)
+
+        visible = {y * self.width + x}
+        for octant in FOV_OCTANTS:
+            self.cast_light(tiles.cells, visible, x, y, 1, 1.0, 0.0, octant)
+
+        changed = visible ^ self.visible
+        for i in visible - self.visible:
+            self.explored.bits[i >> 3] |= 1 << (i & 7)
+        self.visible = visible
+        return changed
+
+    def cast_light(self, cells, visible, cx, cy, row, start, end, octant):
+        if start < end:
+            return
+        xx, xy, yx, yy = octant
+        width, height = self.width, self.height
+        new_start = start
+        for j in range(row, self.radius + 1):
+            dy = -j
+            blocked = False
+            for dx, left_slope, right_slope, in_radius in self.rows[j]:
+                if start < right_slope:
+                    continue
+                if end > left_slope:
+                    break
+
+                map_x = cx + dx * xx + dy * xy
+                map_y = cy + dx * yx + dy * yy
+                if 0 <= map_x < width and 0 <= map_y < height:
+                    i = map_y * width + map_x
+                    if in_radius:
+                        visible.add(i)
+                    wall = cells[i] == 1
+                else:
+                    wall = True
+
+                if blocked:
+                    if wall:
+                        new_start = right_slope
+                    else:
+                        blocked = False
+                        start = new_start
+                elif wall and j < self.radius:
+                    blocked = True
+                    self.cast_light(cells, visible, cx, cy, j + 1,
+                                    start, left_slope, octant)
+                    new_start = right_slope
+            if blocked:
+                break
+
+
 # Dungeon Generator
 class Map:
     def __init__(self):
-        self.mapArr = []
+        self.mapArr = None
         self.roomList = []
 
-    def makeMap(self, xsize, ysize, fail, b1, mrooms):
-        self.mapArr = [[1 for _ in range(xsize)] for _ in range(ysize)]
+    # Placing up to mrooms rooms, giving up after fail misses in a row,
+    # then joining them with corridors that go horizontally first with
+    # a b1 percent chance
+    def makeMap(self, xsize, ysize, fail, b1, mrooms, rng=random):
+        self.mapArr = TileGrid(xsize, ysize, 1)
+        failures = 0
         for _ in range(mrooms):
-            room_w, room_h = random.randint(3, 15), random.randint(3, 15)
-            room_x, room_y = (random.randint
+            room_w, room_h = rng.randint(3, 15), rng.randint(3, 15)
+            room_x, room_y = (rng.randint
                               (1, xsize - room_w - 1),
-                              random.randint(1, ysize - room_h - 1))
+                              rng.randint(1, ysize - room_h - 1))
             new_room = [room_w, room_h, room_x, room_y]
-            if all(not (room_x < r[2] + r[0] and room_x + room_w > r[2] and
-                        room_y < r[3] + r[1]
-                        and room_y + room_h > r[3]) for r in self.roomList):
+            # Corridors come later, so until then the carved floor is
+            # exactly the rooms placed so far and doubles as the index
+            if not self.mapArr.rect_contains(room_x, room_y,
+                                             room_w, room_h, 0):
                 self.roomList.append(new_room)
-                for x in range(room_x, room_x + room_w):
-                    for y in range(room_y, room_y + room_h):
-                        self.mapArr[y][x] = 0
+                self.mapArr.fill_rect(room_x, room_y, room_w, room_h, 0)
+                failures = 0
+            else:
+                failures += 1
+                if failures >= fail:
+                    break
 
         for i in range(len(self.roomList) - 1):
             x1, y1 = (self.roomList[i][2] + self.roomList[i][0]
@@ -242,25 +674,234 @@ class Map:
                       self.roomList[i + 1][0] // 2,
                       self.roomList[i + 1][3] +
                       self.roomList[i + 1][1] // 2)
-            self.create_corridor(x1, y1, x2, y2)
+            self.create_corridor(x1, y1, x2, y2, b1, rng)
 
         last_room = self.roomList[-1]
         self.staircase_pos = (last_room[2] +
                               last_room[0] // 2,
                               last_room[3] + last_room[1] // 2)
-        self.mapArr[self.staircase_pos[1]][self.staircase_pos[0]] = 2
-
-    def create_corridor(self, x1, y1, x2, y2):
-        if random.choice([True, False]):
-            for x in range(min(x1, x2), max(x1, x2) + 1):
-                self.mapArr[y1][x] = 0
-            for y in range(min(y1, y2), max(y1, y2) + 1):
-                self.mapArr[y][x2] = 0
+        self.mapArr[self.staircase_pos] = 2
+
+    def create_corridor(self, x1, y1, x2, y2, b1=50, rng=random):
+        width = abs(x2 - x1) + 1
+        height = abs(y2 - y1) + 1
+        if rng.randrange(100) < b1:
+            self.mapArr.fill_rect(min(x1, x2), y1, width, 1, 0)
+            self.mapArr.fill_rect(x2, min(y1, y2), 1, height, 0)
         else:
-            for y in range(min(y1, y2), max(y1, y2) + 1):
-                self.mapArr[y][x1] = 0
-            for x in range(min(x1, x2), max(x1, x2) + 1):
-                self.mapArr[y2][x] = 0
+            self.mapArr.fill_rect(x1, min(y1, y2), 1, height, 0)
+            self.mapArr.fill_rect(min(x1, x2), y2, width, 1, 0)
+
+
+# Translation table turning tile bytes into a mask of the walls
+WALL_MASK = bytes(int(v == 1) for v in range(256))
+
+
+# Breadth-first search from start through the cells that are still 0
+# in seen, marking them as it goes and yielding one layer per step
+def flood_layers(seen, width, start):
+    size = len(seen)
+    last_column = width - 1
+    seen[start] = 1
+    frontier = [start]
+    while frontier:
+        yield frontier
+        next_frontier = []
+        append = next_frontier.append
+        for i in frontier:
+            n = i - width
+            if n >= 0 and not seen[n]:
+                seen[n] = 1
+                append(n)
+            n = i + width
+            if n < size and not seen[n]:
+                seen[n] = 1
+                append(n)
+            column = i % width
+            if column and not seen[i - 1]:
+                seen[i - 1] = 1
+                append(i - 1)
+            if column < last_column and not seen[i + 1]:
+                seen[i + 1] = 1
+                append(i + 1)
+        frontier = next_frontier
+
+
+# Walking distance noted for tiles that cannot be reached, the largest
+# distance a field can hold is one less
+UNREACHABLE = 0xFFFF
+
+
+# Walking distance in steps from (x, y) to every tile of the map, two
+# bytes a tile, with UNREACHABLE for walls and tiles that cannot be
+# reached. Longer walks than a field can hold are cut short to its
+# largest distance.
+def distance_field(tiles, x, y):
+    distances = array("H", [UNREACHABLE]) * len(tiles.cells)
+    seen = bytearray(tiles.cells.translate(WALL_MASK))
+    start = y * tiles.width + x
+    for steps, layer in enumerate(flood_layers(seen, tiles.width, start)):
+        steps = min(steps, UNREACHABLE - 1)
+        for i in layer:
+            distances[i] = steps
+    return distances
+
+
+# Reachability and walking distances from the start of a level, worked
+# out once when it is generated so that spawning can look them up in O(1)
+class LevelAnalysis:
+    def __init__(self, width, start_distances):
+        self.width = width
+        self.start_distances = start_distances
+
+    @classmethod
+    def of(cls, tiles, start):
+        return cls(tiles.width, distance_field(tiles, *start))
+
+    def reachable(self, x, y):
+        return self.start_distances[y * self.width + x] != UNREACHABLE
+
+
+# Orthogonal steps, the moves available to the player and the enemies
+ORTHOGONAL_STEPS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+
+
+# Walking distances from the player out to a given radius, shared by all
+# enemies, with -1 for tiles out of range. The field is worked out on
+# first use after the player, the map or the radius changes, and only if
+# an enemy is close enough to need it.
+class FlowField:
+    def __init__(self):
+        self.radius = 0
+        self.tiles = None
+        self.origin = None
+        self.distances = array("i")
+        self.reached = []
+        self.ready = False
+
+    def update(self, tiles, x, y, radius):
+        if self.tiles is not tiles:
+            self.tiles = tiles
+            self.distances = array("i", [-1]) * len(tiles.cells)
+            self.reached = []
+            self.ready = False
+        if self.origin != (x, y) or self.radius != radius:
+            self.origin = (x, y)
+            self.radius = radius
+            self.ready = False
+
+    def compute(self):
+        x, y = self.origin
+        width = self.tiles.width
+        distances = self.distances
+        # Clearing only the tiles the last field reached
+        for i in self.reached:
+            distances[i] = -1
+        self.reached = []
+        seen = bytearray(self.tiles.cells.translate(WALL_MASK))
+        for steps, layer in enumerate(flood_layers(seen, width,
+                                                   y * width + x)):
+            for i in layer:
+                distances[i] = steps
+            self.reached.extend(layer)
+            if steps == self.radius:
+                break
+        self.ready = True
+
+    # Whether an enemy at (x, y) may be in range, working the field out
+    # if so
+    def covers(self, x, y):
+        # Walking distance is never shorter than the straight-line one
+        if (abs(x - self.origin[0]) + abs(y - self.origin[1])
+                > self.radius):
+            return False
+        if not self.ready:
+            self.compute()
+        return True
+
+    # Neighbours one step closer to the player, the preferred step first,
+    # or None when (x, y) is out of range of the field
+    def downhill(self, x, y, preferred):
+        if not self.covers(x, y):
+            return None
+        width = self.tiles.width
+        height = self.tiles.height
+        distances = self.distances
+        here = distances[y * width + x]
+        if here < 0:
+            return None
+        steps = [preferred] + [s for s in ORTHOGONAL_STEPS if s != preferred]
+        return [(x + dx, y + dy) for dx, dy in steps
+                if 0 <= x + dx < width and 0 <= y + dy < height
+                and distances[(y + dy) * width + x + dx] == here - 1]
+
+
+flow_field = FlowField()
+
+
+# Translation table turning tile bytes into a mask of the plain floor
+FLOOR_MASK = bytes(int(v == 0) for v in range(256))
+
+# Random draws tried before FreeTiles.sample falls back to a full scan
+FREE_TILE_SAMPLE_TRIES = 64
+
+
+# Floor tiles that no player, enemy or closed chest stands on, one byte
+# per tile. Random free tiles are found by rejection sampling, which
+# takes O(1) tries while a fair share of the map is free floor.
+class FreeTiles:
+    def __init__(self, tiles):
+        self.width = tiles.width
+        self.cells = tiles.cells
+        self.free = bytearray(tiles.cells.translate(FLOOR_MASK))
+        self.count = self.free.count(1)
+
+    def is_free(self, x, y):
+        return self.free[y * self.width + x] == 1
+
+    def take(self, x, y):
+        i = y * self.width + x
+        if self.free[i]:
+            self.free[i] = 0
+            self.count -= 1
+
+    def release(self, x, y):
+        i = y * self.width + x
+        if not self.free[i] and self.cells[i] == 0:
+            self.free[i] = 1
+            self.count += 1
+
+    # A random free tile passing accept(index), or None if there is none
+    def sample(self, rng, accept=None):
+        free = self.free
+        if not self.count:
+            return None
+        for _ in range(FREE_TILE_SAMPLE_TRIES):
+            i = rng.randrange(len(free))
+            if free[i] and (accept is None or accept(i)):
+                return i % self.width, i // self.width
+
+        # Crowded or mostly rejected, pick among every candidate instead
+        candidates = []
+        i = free.find(1)
+        while i != -1:
+            if accept is None or accept(i):
+                candidates.append(i)
+            i = free.find(1, i + 1)
+        if not candidates:
+            return None
+        i = rng.choice(candidates)
+        return i % self.width, i // self.width
+
+
+# Centre tile of a [width, height, x, y] room
+def room_centre(room):
+    return room[2] + room[0] // 2, room[3] + room[1] // 2
+
+
+# Room placement attempts, scaled with the dungeon area
+def room_attempts(base, width, height):
+    return max(base, base * width * height // (VIEW_WIDTH * VIEW_HEIGHT))
 
 
 # Armor class
@@ -271,42 +912,162 @@ class Armor:
         self.sprite = sprite
 
 
-# Game initialization
-themap = Map()
-themap.makeMap(GRID_WIDTH, GRID_HEIGHT, fail=50, b1=50, mrooms=50)
-map_data = themap.mapArr
-staircase_pos = themap.staircase_pos
-first_room = themap.roomList[0]
-player_pos = [first_room[2] + first_room[0]
-              // 2, first_room[3] +
-              first_room[1] // 2]
+# Game initialization, the first level is built by restart_game()
+themap = None
+map_data = None
+level_analysis = None
+free_tiles = None
+
+# Spatial hashes from a tile to the living enemy or the chest on it
+enemy_at = {}
+chest_at = {}
+staircase_pos = (0, 0)
+player_pos = [0, 0]
+treasures = []
+enemies = []
+
+
+# Screen regions of the UI elements, used by the dirty-rect renderer
+HUD_RECT = pygame.Rect(0, SCREEN_HEIGHT - 120, SCREEN_WIDTH, 120)
+WARG_BAR_RECT = pygame.Rect(SCREEN_WIDTH // 2 - 202, 10, 404, 62)
+STATUS_WINDOW_RECT = pygame.Rect(200, 100, 500, 400)
+POTION_SELECTION_RECT = pygame.Rect(SCREEN_WIDTH // 2 - 150,
+                                    SCREEN_HEIGHT // 2 - 100, 300, 200)
+
+# Dirty-rect renderer state
+dirty_rects = []
+previous_scene = {}
+full_redraw = True
+
+
+# Marking a screen rectangle as changed
+def mark_dirty(rect):
+    dirty_rects.append(pygame.Rect(rect))
+
+
+# Forcing the next frame to be redrawn and pushed entirely
+def mark_all_dirty():
+    global full_redraw
+    full_redraw = True
+
+
+# Camera position in pixels, the top-left corner of the view
+camera_x = 0
+camera_y = 0
+
+
+# Centering the camera on the player, clamped to the map edges
+def update_camera():
+    global camera_x, camera_y
+    x = player_pos[0] * TILE_SIZE + TILE_SIZE // 2 - SCREEN_WIDTH // 2
+    y = player_pos[1] * TILE_SIZE + TILE_SIZE // 2 - SCREEN_HEIGHT // 2
+    x = max(0, min(x, GRID_WIDTH * TILE_SIZE - SCREEN_WIDTH))
+    y = max(0, min(y, GRID_HEIGHT * TILE_SIZE - SCREEN_HEIGHT))
+    if x != camera_x or y != camera_y:
+        camera_x, camera_y = x, y
+        mark_all_dirty()
+
+
+# Tiles whose contents can show on screen, as (x0, y0, x1, y1) with the
+# end exclusive, padded by one tile for sprites overhanging their tile
+def visible_tile_range():
+    return (camera_x // TILE_SIZE - 1,
+            camera_y // TILE_SIZE - 1,
+            (camera_x + SCREEN_WIDTH - 1) // TILE_SIZE + 2,
+            (camera_y + SCREEN_HEIGHT - 1) // TILE_SIZE + 2)
+
+
+# Pre-rendered map layer, split into square chunks that are painted the
+# first time they scroll into view and dropped when least recently used
+MAP_CHUNK_SIZE = 16
+MAP_CHUNK_CACHE_SIZE = 48
+map_chunks = OrderedDict()
+
+
+# Painting a single tile into its chunk of the map layer
+def paint_tile(chunk, x, y):
+    rect = ((x % MAP_CHUNK_SIZE) * TILE_SIZE,
+            (y % MAP_CHUNK_SIZE) * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+    if visibility[x, y]:
+        chunk.fill(BLACK, rect)
+        if map_data[x, y] == 1:
+            chunk.blit(wall_tileset, rect)
+        elif map_data[x, y] == 2:
+            chunk.blit(stair_tileset, rect)
+        else:
+            chunk.blit(floor_tileset, rect)
+        # Explored tiles out of sight are drawn dimmed
+        if not fov.is_visible(x, y):
+            chunk.fill(REMEMBERED_TILE_SHADE, rect,
+                       special_flags=pygame.BLEND_RGB_MULT)
+    else:
+        chunk.fill(DARK_GRAY, rect)
+
+
+# Getting a chunk of the map layer, painting it if it is not cached
+def map_chunk(cx, cy):
+    chunk = map_chunks.get((cx, cy))
+    if chunk is not None:
+        map_chunks.move_to_end((cx, cy))
+        return chunk
+
+    chunk_pixels = MAP_CHUNK_SIZE * TILE_SIZE
+    chunk = pygame.Surface((chunk_pixels, chunk_pixels)).convert()
+    chunk.fill(BLACK)
+    for y in range(cy * MAP_CHUNK_SIZE,
+                   min((cy + 1) * MAP_CHUNK_SIZE, GRID_HEIGHT)):
+        for x in range(cx * MAP_CHUNK_SIZE,
+                       min((cx + 1) * MAP_CHUNK_SIZE, GRID_WIDTH)):
+            paint_tile(chunk, x, y)
+
+    map_chunks[(cx, cy)] = chunk
+    if len(map_chunks) > MAP_CHUNK_CACHE_SIZE:
+        map_chunks.popitem(last=False)
+    return chunk
+
+
+# Repainting a tile whose fog state changed
+def repaint_tile(x, y):
+    mark_dirty((x * TILE_SIZE - camera_x, y * TILE_SIZE - camera_y,
+                TILE_SIZE, TILE_SIZE))
+    chunk = map_chunks.get((x // MAP_CHUNK_SIZE, y // MAP_CHUNK_SIZE))
+    if chunk is not None:
+        paint_tile(chunk, x, y)
+
+
+# Dropping the map layer of the previous level
+def reset_map_layer():
+    map_chunks.clear()
+    mark_all_dirty()
 
 
-# Fog of war
+# Fog of war, recomputed from the player's position after each move
 def reveal_area(x, y):
-    for dy in range(-5, 6):
-        for dx in range(-5, 6):
-            nx, ny = x + dx, y + dy
-            if 0 <= nx < GRID_WIDTH and 0 <= ny < GRID_HEIGHT:
-                visibility[ny][nx] = True
+    changed = fov.update(map_data, x, y)
+    # Only tiles that changed visibility are repainted
+    if not headless:
+        for i in changed:
+            repaint_tile(i % GRID_WIDTH, i // GRID_WIDTH)
 
 
-reveal_area(player_pos[0], player_pos[1])
+# Starting the field of view and fog of war of a new level
+def reset_visibility():
+    global fov, visibility
+    # A level of the same size reuses the grid, clearing it in one go
+    if (fov is not None and (fov.width, fov.height, fov.radius)
+            == (GRID_WIDTH, GRID_HEIGHT, FOV_RADIUS)):
+        fov.reset()
+        return
+    fov = FieldOfView(GRID_WIDTH, GRID_HEIGHT, FOV_RADIUS)
+    visibility = fov.explored
 
 
 # Game over screen initialization
 def game_over_screen():
-    replay_button = (pygame.image.load
-                     ("buttons/restartbutton.png").convert_alpha())
-    quit_button = (pygame.image.load
-                   ("buttons/quitbutton.png").convert_alpha())
-
-    # Resize buttons
-    button_width, button_height = 180, 50
-    replay_button = (pygame.transform.scale
-                     (replay_button, (button_width, button_height)))
-    quit_button = pygame.transform.scale(quit_button,
-                                         (button_width, button_height))
+    # Load buttons, resized
+    button_size = (180, 50)
+    replay_button = load_image("buttons/restartbutton.png", button_size)
+    quit_button = load_image("buttons/quitbutton.png", button_size)
 
     # Button positions
     replay_button_rect = replay_button.get_rect(center=(SCREEN_WIDTH //
@@ -317,8 +1078,8 @@ def game_over_screen():
                                                     2 + 150))
 
     # Title font
-    title_font = pygame.font.Font(FONT_PATH, 72)
-    title_text = title_font.render("You're Dead!", True, RED)
+    title_font = load_font(72)
+    title_text = render_text(title_font, "You're Dead!", RED)
 
     while True:
         screen.fill(BLACK)
@@ -331,9 +1092,10 @@ def game_over_screen():
         # Draw buttons
         screen.blit(replay_button, replay_button_rect)
         screen.blit(quit_button, quit_button_rect)
+        pygame.display.flip()
 
         # Handle events
-        for event in pygame.event.get():
+        for event in wait_for_events():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
@@ -346,54 +1108,133 @@ def game_over_screen():
                     pygame.quit()
                     sys.exit()
 
-        pygame.display.flip()
-        clock.tick(15)
 
+# Indexing the enemies and chests of the level by tile, and queueing
+# the enemies for their turns
+def index_entities():
+    global enemy_at, chest_at
+    enemy_at = {(e.x, e.y): e for e in enemies if e.state != DYING}
+    # Everyone starts asleep, move_enemies wakes those near the player
+    dormant_enemies.reset(enemy_at.values())
+    turn_scheduler.reset(())
+    chest_at = {(t["x"], t["y"]): t for t in treasures}
+    animating_enemies.clear()
+    animating_enemies.update(e for e in enemies if e.state != ALIVE)
+
+
+# Switching an enemy to another animation state from its first frame
+def set_enemy_state(enemy, state):
+    enemy.state = state
+    enemy.current_frame = 0
+    enemy.frame_counter = 0
+    if state == ALIVE:
+        animating_enemies.discard(enemy)
+    else:
+        animating_enemies.add(enemy)
+
+
+# Moving an enemy to a free tile, keeping the indexes in step
+def move_enemy(enemy, x, y):
+    del enemy_at[enemy.x, enemy.y]
+    free_tiles.release(enemy.x, enemy.y)
+    enemy.x, enemy.y = x, y
+    enemy_at[x, y] = enemy
+    free_tiles.take(x, y)
+
+
+# Taking a killed enemy off the board while its death animation plays
+def remove_enemy(enemy):
+    del enemy_at[enemy.x, enemy.y]
+    dormant_enemies.discard(enemy)
+    free_tiles.release(enemy.x, enemy.y)
 
+
+# Moving the enemies towards the player, attacking when next to them,
+# each as often as its speed allows in one player turn
 def move_enemies():
+    # The field reaches at least as far as enemies stay awake, whatever
+    # the wake radius was set to
+    flow_field.update(map_data, player_pos[0], player_pos[1],
+                      FLOW_FIELD_WAKE_RADII * ENEMY_WAKE_RADIUS)
+
+    # Waking enemies join the turn order now, without turns owed for
+    # the time they slept
+    for enemy in dormant_enemies.wake(player_pos[0], player_pos[1],
+                                      ENEMY_WAKE_RADIUS, fov.explored):
+        turn_scheduler.add(enemy, 0)
+
+    # Every enemy action due before the player's next turn, in time order.
+    # Enemies due at the same time act in queue order.
+    end_of_turn = turn_scheduler.now + TURN_TIME
+    group = turn_scheduler.next_group(end_of_turn)
+    while group:
+        # Killed enemies leave the queue when their turn comes up, and
+        # enemies the player has got away from fall asleep
+        awake = []
+        for enemy in group:
+            if enemy.state == DYING:
+                continue
+            if (abs(enemy.x - player_pos[0]) > ENEMY_WAKE_RADIUS
+                    or abs(enemy.y - player_pos[1]) > ENEMY_WAKE_RADIUS):
+                dormant_enemies.add(enemy)
+                continue
+            awake.append(enemy)
+            turn_scheduler.add(enemy, ENEMY_ACTION_TIMES[enemy.kind])
+        for enemy in awake:
+            if enemy_action(enemy):
+                return
+        group = turn_scheduler.next_group(end_of_turn)
+
+
+# One enemy action, returning True if it killed the player
+def enemy_action(enemy):
+    dx = player_pos[0] - enemy.x
+    enemy.facing = "right" if dx > 0 else "left"
+    if abs(dx) + abs(player_pos[1] - enemy.y) == 1:
+        return enemy_attack(enemy)
+    step_enemy(enemy)
+    return False
+
+
+# An enemy hitting the player, returning True if the player died
+def enemy_attack(enemy):
     global player_hp, player_animation_state, \
-        player_current_frame, player_frame_counter
+        player_current_frame, player_frame_counter, game_state
 
-    for enemy in enemies:
-        if enemy.get('animation_state') in ['dying', 'attacking']:
-            continue
-
-        dx = player_pos[0] - enemy["x"]
-        dy = player_pos[1] - enemy["y"]
-        enemy["facing"] = "right" if dx > 0 else "left"
-
-        if abs(dx) + abs(dy) == 1:
-            enemy["animation_state"] = "attacking"
-            enemy["current_frame"] = 0
-            enemy["frame_counter"] = 0
-            damage = max(1, enemy["damage"] - strength)
-            player_hp -= damage
-            log.append(f"An {enemy['type']} attacks you for {damage} damage!")
-
-            # Trigging player damage animation
-            player_animation_state = "damaged"
-            player_current_frame = 0
-            player_frame_counter = 0
+    set_enemy_state(enemy, ATTACKING)
+    damage = max(1, enemy.damage - strength)
+    player_hp -= damage
+    log.append(f"An {enemy.name} attacks you for {damage} damage!")
 
-            if player_hp <= 0:
-                log.append("You died!")
-                game_over_screen()
-                return
-        else:
-            if abs(dx) > abs(dy):
-                new_x = enemy["x"] + (1 if dx > 0 else -1)
-                if (0 <= new_x < GRID_WIDTH and
-                        map_data[enemy["y"]][new_x] == 0 and not any(
-                                            e["x"] == new_x and e["y"]
-                                            == enemy["y"] for e in enemies)):
-                    enemy["x"] = new_x
-            else:
-                new_y = enemy["y"] + (1 if dy > 0 else -1)
-                if (0 <= new_y < GRID_HEIGHT and
-                        map_data[new_y][enemy["x"]] == 0 and not any(
-                        e["x"] == enemy["x"] and e["y"]
-                        == new_y for e in enemies)):
-                    enemy["y"] = new_y
+    # Trigging player damage animation
+    player_animation_state = "damaged"
+    player_current_frame = 0
+    player_frame_counter = 0
+
+    if player_hp <= 0:
+        log.append("You died!")
+        game_state = "game_over"
+        return True
+    return False
+
+
+# Following the flow field downhill, preferring the step along the longer
+# axis to the player, which is also the fallback out of its range
+def step_enemy(enemy):
+    dx = player_pos[0] - enemy.x
+    dy = player_pos[1] - enemy.y
+    if abs(dx) > abs(dy):
+        preferred = (1 if dx > 0 else -1, 0)
+    else:
+        preferred = (0, 1 if dy > 0 else -1)
+    candidates = flow_field.downhill(enemy.x, enemy.y, preferred)
+    if candidates is None:
+        candidates = [(enemy.x + preferred[0], enemy.y + preferred[1])]
+    for new_x, new_y in candidates:
+        if (0 <= new_x < GRID_WIDTH and 0 <= new_y < GRID_HEIGHT
+                and free_tiles.is_free(new_x, new_y)):
+            move_enemy(enemy, new_x, new_y)
+            break
 
 
 # Checking the level up state
@@ -413,7 +1254,9 @@ def check_level_up():
 
 
 # Generating random treasures
-def generate_treasures(num_objects):
+def generate_treasures(themap, num_objects, analysis, free_tiles,
+                       rng=random):
+    map_data = themap.mapArr
     corners = []
     for room in themap.roomList:
         room_w, room_h, room_x, room_y = room
@@ -426,80 +1269,75 @@ def generate_treasures(num_objects):
         ]
 
         for x, y, direction in room_corners:
-            if (0 <= x < GRID_WIDTH and 0 <= y
-                    < GRID_HEIGHT and map_data[y][x] == 0):
+            if (0 <= x < map_data.width and 0 <= y
+                    < map_data.height and free_tiles.is_free(x, y)
+                    and analysis.reachable(x, y)):
                 corners.append((x, y, direction))
 
-    selected = random.sample(corners, min(num_objects, len(corners)))
+    selected = rng.sample(corners, min(num_objects, len(corners)))
+    for x, y, _ in selected:
+        free_tiles.take(x, y)
     return [{'x': x, 'y': y, 'state': 'closed',
              'direction': dir} for (x, y, dir) in selected]
 
 
+# A free tile for a new enemy, taken out of the free tiles. Enemies keep
+# their distance from the player's starting tile unless the level is too
+# cramped for that.
+def spawn_tile(free_tiles, analysis, rng):
+    distances = analysis.start_distances
+    tile = free_tiles.sample(
+        rng, lambda i: SAFE_SPAWN_DISTANCE <= distances[i] != UNREACHABLE)
+    if tile is None:
+        tile = free_tiles.sample(rng,
+                                 lambda i: 0 < distances[i] != UNREACHABLE)
+    if tile is not None:
+        free_tiles.take(*tile)
+    return tile
+
+
 # Generating random enemies
-def generate_enemies(num_objects):
-    empty_tiles = [(x, y) for y in range(GRID_HEIGHT)
-                   for x in range(GRID_WIDTH)
-                   if map_data[y][x] == 0]
+def generate_enemies(free_tiles, num_objects, depth, analysis, rng=random):
     enemies = []
 
     # Spawning the warg boss
-    if current_level == 3:
-        x, y = random.choice(empty_tiles)
-        enemies.append({
-            "x": x,
-            "y": y,
-            "type": "warg",
-            "animation_state": "alive",
-            "current_frame": 0,
-            "frame_counter": 0,
-            "health": ENEMY_TYPES["warg"]["health"] * 2,
-            "damage": ENEMY_TYPES["warg"]["damage"],
-            "speed": ENEMY_TYPES["warg"]["speed"],
-            "color": ENEMY_TYPES["warg"]["color"],
-            "facing": "right"
-        })
-        empty_tiles.remove((x, y))
+    tile = spawn_tile(free_tiles, analysis, rng) if depth == 3 else None
+    if tile is not None:
+        x, y = tile
+        enemies.append(Enemy(WARG, x, y, ENEMY_TYPES["warg"]["health"] * 2,
+                             ENEMY_TYPES["warg"]["damage"]))
 
     # Spawn regular enemies
     for _ in range(num_objects):
-        enemy_type = random.choice(["goblin", "slime"])
-        base_stats = ENEMY_TYPES[enemy_type]
-        x, y = random.choice(empty_tiles)
+        tile = spawn_tile(free_tiles, analysis, rng)
+        if tile is None:
+            break
+        x, y = tile
+        kind = rng.choice([GOBLIN, SLIME])
+        base_stats = ENEMY_TYPES[ENEMY_KINDS[kind]]
 
         scaled_health = base_stats["health"] * (1 +
-                                                (current_level - 1)
+                                                (depth - 1)
                                                 * BASE_ENEMY_HEALTH_MULTIPLIER)
         scaled_damage = (base_stats["damage"] +
-                         (current_level - 1)
+                         (depth - 1)
                          * BASE_ENEMY_DAMAGE_INCREMENT)
 
-        enemies.append({
-            "x": x,
-            "y": y,
-            "type": enemy_type,
-            "animation_state": "alive",
-            "current_frame": 0,
-            "frame_counter": 0,
-            "health": scaled_health,
-            "damage": max(MIN_ENEMY_DAMAGE, scaled_damage),
-            "speed": base_stats["speed"],
-            "color": base_stats["color"],
-            "facing": "right"
-        })
+        enemies.append(Enemy(kind, x, y, scaled_health,
+                             max(MIN_ENEMY_DAMAGE, scaled_damage)))
 
     return enemies
 
 
 # Drawing the warg health bar
 def draw_warg_health_bar():
-    warg = next((e for e in enemies if e["type"]
-                 == "warg" and e["animation_state"]
-                 != "dying"), None)
+    warg = next((e for e in enemies if e.kind == WARG
+                 and e.state != DYING), None)
     if warg:
         # Draw health bar
         health_bar_width = 400
         health_bar_height = 20
-        health_ratio = warg["health"] / (ENEMY_TYPES["warg"]["health"] * 2)
+        health_ratio = warg.health / (ENEMY_TYPES["warg"]["health"] * 2)
         pygame.draw.rect(screen, RED, (SCREEN_WIDTH // 2
                                        - health_bar_width // 2, 50,
                                        health_bar_width *
@@ -510,155 +1348,110 @@ def draw_warg_health_bar():
                                          health_bar_height), 2)
 
         # Draw Warg sprite above the health bar
-        warg_sprite_scaled = pygame.transform.scale(warg_sprite, (64, 64))
-        screen.blit(warg_sprite_scaled, (SCREEN_WIDTH // 2 - 32, 10))
-
-
-treasures = generate_treasures(3)
-enemies = generate_enemies(5 + current_level)
+        screen.blit(load_image("enemies/warg.png", (64, 64)),
+                    (SCREEN_WIDTH // 2 - 32, 10))
 
 
 # Drawing the randomized map
 def draw_map():
-    for y in range(GRID_HEIGHT):
-        for x in range(GRID_WIDTH):
-            if visibility[y][x]:
-                if map_data[y][x] == 1:
-                    screen.blit(wall_tileset, (x * TILE_SIZE, y * TILE_SIZE))
-                elif map_data[y][x] == 2:
-                    screen.blit(stair_tileset, (x * TILE_SIZE, y * TILE_SIZE))
-                else:
-                    screen.blit(floor_tileset, (x * TILE_SIZE, y * TILE_SIZE))
-            else:
-                pygame.draw.rect(screen, DARK_GRAY,
-                                 (x * TILE_SIZE, y * TILE_SIZE,
-                                  TILE_SIZE, TILE_SIZE))
-
-
-# Drawing chest and enemies
-def draw_objects():
-    global enemies
-
-    # Draw treasures
+    chunk_pixels = MAP_CHUNK_SIZE * TILE_SIZE
+    last_cx = min((camera_x + SCREEN_WIDTH - 1) // chunk_pixels,
+                  (GRID_WIDTH - 1) // MAP_CHUNK_SIZE)
+    last_cy = min((camera_y + SCREEN_HEIGHT - 1) // chunk_pixels,
+                  (GRID_HEIGHT - 1) // MAP_CHUNK_SIZE)
+    for cy in range(camera_y // chunk_pixels, last_cy + 1):
+        for cx in range(camera_x // chunk_pixels, last_cx + 1):
+            screen.blit(map_chunk(cx, cy), (cx * chunk_pixels - camera_x,
+                                            cy * chunk_pixels - camera_y))
+
+
+# Enemies in sight within a tile range, top to bottom. Crowded levels
+# are searched through the tile index instead of walking every enemy.
+def visible_enemies(x0, y0, x1, y1):
+    if len(enemies) < (x1 - x0) * (y1 - y0):
+        found = [e for e in enemies
+                 if x0 <= e.x < x1 and y0 <= e.y < y1]
+    else:
+        found = [enemy_at[x, y] for y in range(y0, y1)
+                 for x in range(x0, x1) if (x, y) in enemy_at]
+        # Dying enemies have left the index but still play their animation
+        found.extend(e for e in animating_enemies if e.state == DYING
+                     and x0 <= e.x < x1 and y0 <= e.y < y1)
+    found = [e for e in found if fov.is_visible(e.x, e.y)]
+    found.sort(key=lambda e: (e.y, e.x))
+    return found
+
+
+# Collecting the on-screen chest, enemy and player sprites in draw order
+def scene_sprites():
+    x0, y0, x1, y1 = visible_tile_range()
+    sprites = []
     for treasure in treasures:
-        if visibility[treasure['y']][treasure['x']]:
-            if treasure['state'] == 'closed':
-                img = pygame.transform.flip(closed_chest,
-                                            treasure['direction']
-                                            == 'west', False)
-            else:
-                img = pygame.transform.flip(open_chest,
-                                            treasure['direction']
-                                            == 'west', False)
-            screen.blit(img, (treasure['x'] *
-                              TILE_SIZE, treasure['y']
-                              * TILE_SIZE))
-
-    # Draw enemies
-    for enemy in enemies[:]:
-        if visibility[enemy["y"]][enemy["x"]]:
-            if enemy["animation_state"] == "dying":
-                if enemy["type"] == "slime":
-                    frames = slime_death_frames
-                elif enemy["type"] == "goblin":
-                    frames = goblin_death_frames
-                screen.blit(frames[enemy["current_frame"]],
-                            (enemy["x"] * TILE_SIZE - SPRITE_OFFSET_X,
-                             enemy["y"] * TILE_SIZE - SPRITE_OFFSET_Y))
-                enemy["frame_counter"] += 1
-                if enemy["frame_counter"] >= 3:
-                    enemy["current_frame"] += 1
-                    enemy["frame_counter"] = 0
-                    if enemy["current_frame"] >= len(frames):
-                        enemies.remove(enemy)
-
-            elif enemy["animation_state"] == "attacking":
-                if enemy["type"] == "goblin":
-                    sprites = goblin_attack_sprites
-                elif enemy["type"] == "slime":
-                    sprites = slime_attack_sprites
-                elif enemy["type"] == "warg":
-                    sprites = warg_attack_sprites
-
-                current_sprite = sprites[enemy["current_frame"]]
-                if enemy["facing"] == "left":
-                    current_sprite = (pygame.transform.flip
-                                      (current_sprite, True, False))
-
-                screen.blit(current_sprite, (enemy["x"] *
-                                             TILE_SIZE - SPRITE_OFFSET_X,
-                                             enemy["y"] *
-                                             TILE_SIZE - SPRITE_OFFSET_Y))
-
-                enemy["frame_counter"] += 1
-                if enemy["frame_counter"] >= 3:
-                    enemy["current_frame"] += 1
-                    enemy["frame_counter"] = 0
-                    if enemy["current_frame"] >= len(sprites):
-                        enemy["animation_state"] = "alive"
-
-            elif enemy["animation_state"] == "damaged":
-                if enemy["type"] == "goblin":
-                    frames = goblin_damage_frames
-                elif enemy["type"] == "warg":
-                    frames = warg_damage_frames
-                else:
-                    frames = []
-                if frames:
-                    current_sprite = frames[enemy["current_frame"]]
-                    if enemy["facing"] == "left":
-                        current_sprite = (pygame.transform.flip
-                                          (current_sprite, True, False))
-
-                    screen.blit(current_sprite, (enemy["x"] * TILE_SIZE -
-                                                 SPRITE_OFFSET_X, enemy["y"] *
-                                                 TILE_SIZE - SPRITE_OFFSET_Y))
-
-                    enemy["frame_counter"] += 1
-                    if enemy["frame_counter"] >= 3:
-                        enemy["current_frame"] += 1
-                        enemy["frame_counter"] = 0
-                        if enemy["current_frame"] >= len(frames):
-                            enemy["animation_state"] = "alive"
-
-            else:
-                if enemy["type"] == "goblin":
-                    sprite = pygame.transform.flip(
-                        goblin_sprite, enemy["facing"] == "left", False)
-                elif enemy["type"] == "slime":
-                    sprite = pygame.transform.flip(
-                        slime_sprite, enemy["facing"] == "left", False)
-                elif enemy["type"] == "warg":
-                    sprite = pygame.transform.flip(
-                        warg_sprite, enemy["facing"] == "left", False)
-
-                screen.blit(sprite, (enemy["x"] * TILE_SIZE -
-                                     SPRITE_OFFSET_X, enemy["y"] *
-                                     TILE_SIZE - SPRITE_OFFSET_Y))
-
-    # Draw player
-    if player_animation_state == "attacking":
-        if player_direction == "right":
-            current_sprite = attack_right_sprites[player_current_frame]
-        elif player_direction == "left":
-            current_sprite = (pygame.transform.flip
-                              (attack_right_sprites[player_current_frame],
-                               True, False))
+        if (x0 <= treasure['x'] < x1 and y0 <= treasure['y'] < y1
+                and visibility[treasure['x'], treasure['y']]):
+            facing = "left" if treasure['direction'] == 'west' else "right"
+            sprites.append((id(treasure),
+                            ("chest", treasure['state'], 0, facing),
+                            (treasure['x'] * TILE_SIZE - camera_x,
+                             treasure['y'] * TILE_SIZE - camera_y)))
+
+    for enemy in visible_enemies(x0, y0, x1, y1):
+        name = ENEMY_KINDS[enemy.kind]
+        state = ENEMY_STATES[enemy.state]
+        if enemy.state == ALIVE or not enemy_animation_lengths[
+                enemy.kind][enemy.state]:
+            key = (name, "alive", 0, enemy.facing)
+        elif enemy.state == DYING:
+            # Death frames are never mirrored
+            key = (name, state, enemy.current_frame, "right")
         else:
-            current_sprite = attack_right_sprites[player_current_frame]
-    elif player_animation_state == "damaged":
-        current_sprite = player_damage_frames[player_current_frame]
-        if player_direction == "left":
-            current_sprite = pygame.transform.flip(current_sprite, True, False)
+            key = (name, state, enemy.current_frame, enemy.facing)
+        sprites.append((id(enemy), key,
+                        (enemy.x * TILE_SIZE - SPRITE_OFFSET_X - camera_x,
+                         enemy.y * TILE_SIZE - SPRITE_OFFSET_Y - camera_y)))
+
+    facing = "left" if player_direction == "left" else "right"
+    if player_animation_state in ("attacking", "damaged"):
+        key = ("player", player_animation_state,
+               player_current_frame, facing)
     else:
-        if player_direction == "left":
-            current_sprite = pygame.transform.flip(player_sprite, True, False)
-        else:
-            current_sprite = player_sprite
+        key = ("player", "idle", 0, facing)
+    sprites.append(("player", key,
+                    (player_pos[0] * TILE_SIZE - SPRITE_OFFSET_X - camera_x,
+                     player_pos[1] * TILE_SIZE - SPRITE_OFFSET_Y
+                     - camera_y)))
+    return sprites
 
-    screen.blit(current_sprite, (player_pos[0] *
-                                 TILE_SIZE - SPRITE_OFFSET_X,
-                                 player_pos[1] * TILE_SIZE - SPRITE_OFFSET_Y))
+
+# Drawing chest and enemies
+def draw_objects():
+    for _, key, pos in scene_sprites():
+        screen.blit(sprite_atlas[key], pos)
+
+
+# Dropping an enemy whose death animation has finished
+def discard_enemy(enemy):
+    animating_enemies.discard(enemy)
+    enemies.remove(enemy)
+
+
+# Advancing the enemy animation frames once per frame
+def advance_enemy_animations():
+    for enemy in list(animating_enemies):
+        frame_count = enemy_animation_lengths[enemy.kind][enemy.state]
+        if frame_count:
+            enemy.frame_counter += 1
+            if enemy.frame_counter >= 3:
+                enemy.current_frame += 1
+                enemy.frame_counter = 0
+                if enemy.current_frame >= frame_count:
+                    if enemy.state == DYING:
+                        discard_enemy(enemy)
+                    else:
+                        set_enemy_state(enemy, ALIVE)
+        elif enemy.state == DYING:
+            # No death animation for this enemy type
+            discard_enemy(enemy)
 
 
 # Drawing User Interface
@@ -674,15 +1467,15 @@ def draw_ui():
     pygame.draw.rect(screen, WHITE, pygame.Rect
                      (10, SCREEN_HEIGHT - 20, 200, 10), 1)
 
-    level_text = font.render(f"Player: {player_level} "
+    level_text = render_text(font, f"Player: {player_level} "
                              f"| Dungeon: {current_level} | "
                              f"XP: {player_xp}/{xp_for_next_level}",
-                             True, WHITE)
+                             WHITE)
     screen.blit(level_text, (10, SCREEN_HEIGHT - 60))
 
     y_offset = SCREEN_HEIGHT - 80
     for line in log[-3:]:
-        text = font.render(line, True, WHITE)
+        text = render_text(font, line, WHITE)
         screen.blit(text, (10, y_offset))
         y_offset -= 20
 
@@ -693,7 +1486,7 @@ def draw_status_window():
     status_surface.fill(DARK_GRAY)
     pygame.draw.rect(status_surface, WHITE, status_surface.get_rect(), 2)
 
-    title = font.render("Character Stats & Inventory", True, WHITE)
+    title = render_text(font, "Character Stats & Inventory", WHITE)
     status_surface.blit(title, (10, 10))
 
     stats = [
@@ -707,17 +1500,18 @@ def draw_status_window():
 
     y_offset = 40
     for stat in stats:
-        stat_text = font.render(stat, True, WHITE)
+        stat_text = render_text(font, stat, WHITE)
         status_surface.blit(stat_text, (10, y_offset))
         y_offset += 20
-    inventory_title = font.render("Inventory:", True, WHITE)
+    inventory_title = render_text(font, "Inventory:", WHITE)
     status_surface.blit(inventory_title, (10, y_offset))
     y_offset += 30
 
+    tile = (TILE_SIZE, TILE_SIZE)
     potion_entries = [
-        ("Small Potion", small_potion_sprite),
-        ("Medium Potion", medium_potion_sprite),
-        ("Large Potion", large_potion_sprite)
+        ("Small Potion", load_image("potions/smallpotion.png", tile)),
+        ("Medium Potion", load_image("potions/mediumpotion.png", tile)),
+        ("Large Potion", load_image("potions/largepotion.png", tile))
     ]
 
     for potion_name, sprite in potion_entries:
@@ -725,25 +1519,29 @@ def draw_status_window():
         status_surface.blit(sprite, (10, y_offset - 5))
         # Draw potion text
         count = inventory[potion_name]
-        item_text = font.render(f"{potion_name}: {count}", True, WHITE)
+        item_text = render_text(font, f"{potion_name}: {count}", WHITE)
         status_surface.blit(item_text, (50, y_offset))
         y_offset += 40
 
     # Draw armor on the right side
-    armor_title = font.render("Armor:", True, WHITE)
+    armor_title = render_text(font, "Armor:", WHITE)
     status_surface.blit(armor_title, (250, 40))
     y_offset_armor = 80
 
     armor_slots = [
-        ("Helmet", "helmet", empty_helmet),
-        ("Chestplate", "chestplate", empty_chestplate),
-        ("Leggings", "leggings", empty_leggings),
-        ("Boots", "boots", empty_boots)
+        ("Helmet", "helmet",
+         load_image("emptyarmor/emptyhelmet.png", (32, 32))),
+        ("Chestplate", "chestplate",
+         load_image("emptyarmor/emptychestplate.png", (32, 32))),
+        ("Leggings", "leggings",
+         load_image("emptyarmor/emptylegings.png", (32, 32))),
+        ("Boots", "boots",
+         load_image("emptyarmor/emptyboots.png", (32, 32)))
     ]
 
     for slot_name, slot_type, empty_sprite in armor_slots:
         # Draw slot name
-        slot_text = font.render(slot_name, True, WHITE)
+        slot_text = render_text(font, slot_name, WHITE)
         status_surface.blit(slot_text, (250, y_offset_armor))
 
         # Draw armor sprite (empty or equipped)
@@ -765,19 +1563,21 @@ def draw_potion_selection():
     selection_surface.fill(DARK_GRAY)
     pygame.draw.rect(selection_surface, WHITE, selection_surface.get_rect(), 2)
 
-    title = font.render("Select Potion:", True, WHITE)
+    title = render_text(font, "Select Potion:", WHITE)
     selection_surface.blit(title, (10, 10))
 
     y_offset = 40
+    tile = (TILE_SIZE, TILE_SIZE)
     potion_list = [
-        ("Small Potion", small_potion_sprite, "1"),
-        ("Medium Potion", medium_potion_sprite, "2"),
-        ("Large Potion", large_potion_sprite, "3")
+        ("Small Potion", load_image("potions/smallpotion.png", tile), "1"),
+        ("Medium Potion", load_image("potions/mediumpotion.png", tile),
+         "2"),
+        ("Large Potion", load_image("potions/largepotion.png", tile), "3")
     ]
 
     for i, (potion_name, sprite, key) in enumerate(potion_list):
         # Draw key number
-        key_text = font.render(f"{key}.", True, WHITE)
+        key_text = render_text(font, f"{key}.", WHITE)
         selection_surface.blit(key_text, (10, y_offset))
 
         # Draw potion image
@@ -785,7 +1585,7 @@ def draw_potion_selection():
 
         # Draw potion name and count
         count = inventory[potion_name]
-        text = font.render(f"{potion_name} ({count})", True, WHITE)
+        text = render_text(font, f"{potion_name} ({count})", WHITE)
         selection_surface.blit(text, (80, y_offset))
 
         y_offset += 50
@@ -795,24 +1595,533 @@ def draw_potion_selection():
                  SCREEN_HEIGHT // 2 - 100))
 
 
-# Generating the new level of the dungeon
-def generate_new_level():
-    global themap, map_data, player_pos, treasures, \
-        enemies, visibility, staircase_pos, current_level
-    current_level += 1
+# A complete dungeon level, built away from any game globals so that
+# it can be pickled across from a worker process
+class Level:
+    def __init__(self, depth, themap, treasures, enemies, analysis,
+                 free_tiles):
+        self.depth = depth
+        self.themap = themap
+        self.treasures = treasures
+        self.enemies = enemies
+        self.analysis = analysis
+        self.free_tiles = free_tiles
+        self.player_pos = list(room_centre(themap.roomList[0]))
+
+
+# Bump whenever generation changes, so that cached levels are rebuilt
+GENERATOR_VERSION = 6
+
+# Generated levels stored on disk, or None to always generate
+LEVEL_CACHE_DIR = ".level_cache"
+level_cache_dir = None
+
+LEVEL_CACHE_MAGIC = b"DCLV"
+LEVEL_HEADER = struct.Struct("<HIHHHIII")
+LEVEL_ROOM = struct.Struct("<4H")
+LEVEL_CHEST = struct.Struct("<HHB")
+LEVEL_ENEMY = struct.Struct("<BHHii")
+CHEST_DIRECTIONS = ["east", "west"]
+
+
+# Seed of one level of a run, independent of the levels before it
+def level_seed(seed, depth):
+    return random.Random(f"{seed}:{depth}").getrandbits(32)
+
+
+def level_cache_path(cache_dir, seed, depth, width, height):
+    return os.path.join(cache_dir, f"{seed}-{depth}-{width}x{height}"
+                                   f"-v{GENERATOR_VERSION}.lvl")
+
+
+# The cache stores the distance field little-endian, swapping bytes when
+# this machine is big-endian
+def little_endian(field):
+    if sys.byteorder == "big":
+        field = array(field.typecode, field)
+        field.byteswap()
+    return field
+
+
+# Packing a freshly generated level into the compressed cache format
+def pack_level(level, seed):
+    themap = level.themap
+    data = [LEVEL_HEADER.pack(GENERATOR_VERSION, seed, level.depth,
+                              themap.mapArr.width, themap.mapArr.height,
+                              len(themap.roomList), len(level.treasures),
+                              len(level.enemies))]
+    for room in themap.roomList:
+        data.append(LEVEL_ROOM.pack(*room))
+    for treasure in level.treasures:
+        data.append(LEVEL_CHEST.pack(
+            treasure["x"], treasure["y"],
+            CHEST_DIRECTIONS.index(treasure["direction"])))
+    for enemy in level.enemies:
+        data.append(LEVEL_ENEMY.pack(
+            enemy.kind, enemy.x, enemy.y, enemy.health, enemy.damage))
+    data.append(struct.pack("<HH", *themap.staircase_pos))
+    data.append(bytes(themap.mapArr.cells))
+    data.append(little_endian(level.analysis.start_distances).tobytes())
+    return LEVEL_CACHE_MAGIC + zlib.compress(b"".join(data))
+
+
+def unpack_level(blob):
+    if blob[:4] != LEVEL_CACHE_MAGIC:
+        raise ValueError("not a level cache file")
+    data = zlib.decompress(blob[4:])
+    (version, seed, depth, width, height, num_rooms, num_chests,
+     num_enemies) = LEVEL_HEADER.unpack_from(data)
+    if version != GENERATOR_VERSION:
+        raise ValueError(f"level cache version {version}")
+    offset = LEVEL_HEADER.size
+
     themap = Map()
-    themap.makeMap(GRID_WIDTH, GRID_HEIGHT, fail=50, b1=50, mrooms=20)
+    for _ in range(num_rooms):
+        themap.roomList.append(list(LEVEL_ROOM.unpack_from(data, offset)))
+        offset += LEVEL_ROOM.size
+    treasures = []
+    for _ in range(num_chests):
+        x, y, direction = LEVEL_CHEST.unpack_from(data, offset)
+        offset += LEVEL_CHEST.size
+        treasures.append({'x': x, 'y': y, 'state': 'closed',
+                          'direction': CHEST_DIRECTIONS[direction]})
+    enemies = []
+    for _ in range(num_enemies):
+        kind, x, y, health, damage = LEVEL_ENEMY.unpack_from(data, offset)
+        offset += LEVEL_ENEMY.size
+        enemies.append(Enemy(kind, x, y, health, damage))
+    themap.staircase_pos = struct.unpack_from("<HH", data, offset)
+    offset += 4
+    size = width * height
+    themap.mapArr = TileGrid(width, height)
+    themap.mapArr.cells[:] = data[offset:offset + size]
+    offset += size
+    if len(data) != offset + 2 * size:
+        raise ValueError("truncated level cache file")
+
+    distances = array("H")
+    distances.frombytes(data[offset:])
+    analysis = LevelAnalysis(width, little_endian(distances))
+
+    free_tiles = FreeTiles(themap.mapArr)
+    free_tiles.take(*room_centre(themap.roomList[0]))
+    for treasure in treasures:
+        free_tiles.take(treasure["x"], treasure["y"])
+    for enemy in enemies:
+        free_tiles.take(enemy.x, enemy.y)
+    return Level(depth, themap, treasures, enemies, analysis, free_tiles)
+
+
+# Generating the level at a given depth of a run
+def generate_level(seed, depth, width, height):
+    rng = random.Random(level_seed(seed, depth))
+    # The first level has more rooms but fewer chests than the deeper ones
+    if depth == 1:
+        rooms, chests = room_attempts(50, width, height), 3
+    else:
+        rooms, chests = room_attempts(20, width, height), 5
+
+    # Corridors always join consecutive rooms, but a level whose stairs
+    # cannot be reached is never handed out
+    while True:
+        themap = Map()
+        themap.makeMap(width, height, fail=50, b1=50, mrooms=rooms,
+                       rng=rng)
+        analysis = LevelAnalysis.of(themap.mapArr,
+                                    room_centre(themap.roomList[0]))
+        if analysis.reachable(*themap.staircase_pos):
+            break
+
+    free_tiles = FreeTiles(themap.mapArr)
+    free_tiles.take(*room_centre(themap.roomList[0]))
+    treasures = generate_treasures(themap, chests, analysis, free_tiles, rng)
+    enemies = generate_enemies(free_tiles, 5 + depth, depth, analysis, rng)
+    return Level(depth, themap, treasures, enemies, analysis, free_tiles)
+
+
+# Building a level, from the level cache when it holds a copy
+def build_level(seed, depth, width, height, cache_dir=None):
+    if cache_dir is None:
+        return generate_level(seed, depth, width, height)
+
+    path = level_cache_path(cache_dir, seed, depth, width, height)
+    try:
+        with open(path, "rb") as f:
+            return unpack_level(f.read())
+    except (OSError, ValueError, struct.error, zlib.error):
+        pass
+
+    level = generate_level(seed, depth, width, height)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(pack_level(level, seed))
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+    return level
+
+
+# Building the next level in a worker process while the current one is
+# played, or when it is taken if no worker is available
+class LevelPrefetcher:
+    def __init__(self):
+        self.executor = None
+        self.pending = None
+
+    def start(self):
+        try:
+            self.executor = ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        except (OSError, NotImplementedError):
+            self.executor = None
+
+    # Queueing up a level, dropping the one asked for before so that a
+    # restart or a load does not leave the worker busy with a stale job
+    def request(self, depth):
+        self.cancel()
+        args = (run_seed, depth, GRID_WIDTH, GRID_HEIGHT, level_cache_dir)
+        future = None
+        if self.executor is not None:
+            try:
+                future = self.executor.submit(build_level, *args)
+            except (OSError, RuntimeError):
+                self.executor = None
+        self.pending = (args, future)
+
+    def cancel(self):
+        if self.pending is not None and self.pending[1] is not None:
+            self.pending[1].cancel()
+        self.pending = None
+
+    # The level for depth of the current run, built here unless the one
+    # queued up matches the seed, depth and map size
+    def take(self, depth):
+        args = (run_seed, depth, GRID_WIDTH, GRID_HEIGHT, level_cache_dir)
+        if self.pending is None or self.pending[0] != args:
+            self.cancel()
+            return build_level(*args)
+        future = self.pending[1]
+        self.pending = None
+        if future is not None:
+            try:
+                return future.result()
+            except (OSError, BrokenProcessPool):
+                self.executor = None
+        return build_level(*args)
+
+
+level_prefetcher = LevelPrefetcher()
+
+
+# Swapping in a ready-made level and queueing up the one below it, with
+# the explored tiles of a saved game if given
+def enter_level(level, explored=None):
+    global themap, map_data, staircase_pos, player_pos, treasures, \
+        enemies, level_analysis, free_tiles
+    themap = level.themap
     map_data = themap.mapArr
     staircase_pos = themap.staircase_pos
-    first_room = themap.roomList[0]
-    player_pos = [first_room[2] + first_room[0] // 2,
-                  first_room[3] + first_room[1] // 2]
-    treasures = generate_treasures(5)
-    enemies = generate_enemies(5 + current_level)
-    visibility = [[False] * GRID_WIDTH for _ in range(GRID_HEIGHT)]
+    player_pos = level.player_pos
+    treasures = level.treasures
+    enemies = level.enemies
+    level_analysis = level.analysis
+    free_tiles = level.free_tiles
+    index_entities()
+    reset_visibility()
+    if explored is not None:
+        fov.explored.bits[:] = explored
+    reset_map_layer()
     reveal_area(player_pos[0], player_pos[1])
+    level_prefetcher.request(level.depth + 1)
+
+
+# Generating the new level of the dungeon
+def generate_new_level():
+    global current_level
+    current_level += 1
+    enter_level(level_prefetcher.take(current_level))
     log.append(f"Descended to dungeon level {current_level}!")
     log.append("Enemies grow stronger!")
+    save_game()
+
+
+# Saved games, written by F5 and on every descent, loaded by F9
+SAVE_PATH = "savegame.sav"
+SAVE_VERSION = 2
+SAVE_MAGIC = b"DCSV"
+SAVE_HEADER = struct.Struct("<HIHHHIIIIqQ")
+SAVE_PLAYER = struct.Struct("<HHiiiiiiiiB")
+SAVE_INVENTORY = struct.Struct("<III")
+SAVE_RANDOM = struct.Struct("<625I?d")
+SAVE_CHEST = struct.Struct("<HHBB")
+SAVE_ENEMY = struct.Struct("<BHHiiBBHHqQ")
+SAVE_TEXT = struct.Struct("<H")
+DIRECTIONS = ["right", "left", "up", "down"]
+POTIONS = ["Small Potion", "Medium Potion", "Large Potion"]
+ARMOR_SLOTS = ["helmet", "chestplate", "leggings", "boots"]
+
+
+# Copying the game state that later turns change, so that it can be
+# packed on another thread while the game goes on
+def snapshot_game():
+    due = {id(actor): (due_time, order)
+           for due_time, order, actor in turn_scheduler.queue}
+    return {
+        "seed": run_seed,
+        "depth": current_level,
+        "themap": themap,
+        "cells": bytes(map_data.cells),
+        "explored": bytes(fov.explored.bits),
+        "analysis": level_analysis,
+        "player": (player_pos[0], player_pos[1], player_hp, player_max_hp,
+                   player_xp, player_level, xp_for_next_level, stat_points,
+                   strength, vitality, DIRECTIONS.index(player_direction)),
+        "inventory": [inventory[name] for name in POTIONS],
+        "armor": [armor.name if armor else ""
+                  for armor in map(equipped_armor.get, ARMOR_SLOTS)],
+        "random": loot_rng.getstate(),
+        "chests": [(t["x"], t["y"], CHEST_DIRECTIONS.index(t["direction"]),
+                    t["state"] == "open") for t in treasures],
+        # Enemies still dying are gone from the board already
+        "enemies": [(e.kind, e.x, e.y, e.health, e.damage, e.state,
+                     DIRECTIONS.index(e.facing), e.current_frame,
+                     e.frame_counter) + due.get(id(e), (-1, 0))
+                    for e in enemies if e.state != DYING],
+        "now": turn_scheduler.now,
+        "order": turn_scheduler.order,
+        "log": list(log)
+    }
+
+
+def pack_text(text):
+    data = text.encode()
+    return SAVE_TEXT.pack(len(data)) + data
+
+
+def unpack_text(data, offset):
+    size, = SAVE_TEXT.unpack_from(data, offset)
+    offset += SAVE_TEXT.size
+    return data[offset:offset + size].decode(), offset + size
+
+
+# Packing a snapshot into the save format, with the walls and the fog of
+# war one bit per tile
+def pack_save(snapshot):
+    themap = snapshot["themap"]
+    analysis = snapshot["analysis"]
+    log_text = "\n".join(snapshot["log"]).encode()
+    data = [SAVE_HEADER.pack(SAVE_VERSION, snapshot["seed"],
+                             snapshot["depth"], themap.mapArr.width,
+                             themap.mapArr.height, len(themap.roomList),
+                             len(snapshot["chests"]),
+                             len(snapshot["enemies"]), len(log_text),
+                             snapshot["now"], snapshot["order"]),
+            SAVE_PLAYER.pack(*snapshot["player"]),
+            SAVE_INVENTORY.pack(*snapshot["inventory"])]
+    data.extend(pack_text(name) for name in snapshot["armor"])
+    _, state, gauss = snapshot["random"]
+    data.append(SAVE_RANDOM.pack(*state, gauss is not None, gauss or 0))
+    for room in themap.roomList:
+        data.append(LEVEL_ROOM.pack(*room))
+    data.append(struct.pack("<HH", *themap.staircase_pos))
+    for chest in snapshot["chests"]:
+        data.append(SAVE_CHEST.pack(*chest))
+    for enemy in snapshot["enemies"]:
+        data.append(SAVE_ENEMY.pack(*enemy))
+    data.append(log_text)
+    data.append(pack_bits(snapshot["cells"].translate(WALL_MASK)))
+    data.append(snapshot["explored"])
+    data.append(little_endian(analysis.start_distances).tobytes())
+    return SAVE_MAGIC + zlib.compress(b"".join(data))
+
+
+# Unpacking a save into the level it was made on and the rest of the
+# state, as a dict
+def unpack_save(blob):
+    if blob[:4] != SAVE_MAGIC:
+        raise ValueError("not a saved game")
+    data = zlib.decompress(blob[4:])
+    (version, seed, depth, width, height, num_rooms, num_chests,
+     num_enemies, log_size, now, order) = SAVE_HEADER.unpack_from(data)
+    if version != SAVE_VERSION:
+        raise ValueError(f"save version {version}")
+    offset = SAVE_HEADER.size
+    saved = {"seed": seed, "depth": depth, "now": now, "order": order,
+             "width": width, "height": height}
+
+    saved["player"] = SAVE_PLAYER.unpack_from(data, offset)
+    offset += SAVE_PLAYER.size
+    saved["inventory"] = SAVE_INVENTORY.unpack_from(data, offset)
+    offset += SAVE_INVENTORY.size
+    saved["armor"] = []
+    for _ in ARMOR_SLOTS:
+        name, offset = unpack_text(data, offset)
+        saved["armor"].append(name)
+    *state, has_gauss, gauss = SAVE_RANDOM.unpack_from(data, offset)
+    offset += SAVE_RANDOM.size
+    saved["random"] = (3, tuple(state), gauss if has_gauss else None)
+
+    themap = Map()
+    for _ in range(num_rooms):
+        themap.roomList.append(list(LEVEL_ROOM.unpack_from(data, offset)))
+        offset += LEVEL_ROOM.size
+    themap.staircase_pos = struct.unpack_from("<HH", data, offset)
+    offset += 4
+    treasures = []
+    for _ in range(num_chests):
+        x, y, direction, opened = SAVE_CHEST.unpack_from(data, offset)
+        offset += SAVE_CHEST.size
+        treasures.append({'x': x, 'y': y,
+                          'state': 'open' if opened else 'closed',
+                          'direction': CHEST_DIRECTIONS[direction]})
+    enemies = []
+    saved["due"] = []
+    for _ in range(num_enemies):
+        (kind, x, y, health, damage, state, facing, current_frame,
+         frame_counter, due_time, order) = SAVE_ENEMY.unpack_from(data, offset)
+        offset += SAVE_ENEMY.size
+        enemy = Enemy(kind, x, y, health, damage)
+        enemy.state = state
+        enemy.facing = DIRECTIONS[facing]
+        enemy.current_frame = current_frame
+        enemy.frame_counter = frame_counter
+        enemies.append(enemy)
+        saved["due"].append((due_time, order))
+    saved["log"] = data[offset:offset + log_size].decode().split("\n")
+    if not log_size:
+        saved["log"] = []
+    offset += log_size
+
+    size = width * height
+    bits_size = (size + 7) // 8
+    if len(data) != offset + 2 * bits_size + 2 * size:
+        raise ValueError("truncated saved game")
+    themap.mapArr = TileGrid(width, height)
+    themap.mapArr.cells[:] = unpack_bits(data[offset:offset + bits_size],
+                                         size)
+    themap.mapArr[themap.staircase_pos] = 2
+    offset += bits_size
+    saved["explored"] = data[offset:offset + bits_size]
+    offset += bits_size
+    distances = array("H")
+    distances.frombytes(data[offset:])
+    analysis = LevelAnalysis(width, little_endian(distances))
+
+    x, y = saved["player"][:2]
+    free_tiles = FreeTiles(themap.mapArr)
+    free_tiles.take(x, y)
+    for treasure in treasures:
+        if treasure["state"] == "closed":
+            free_tiles.take(treasure["x"], treasure["y"])
+    for enemy in enemies:
+        free_tiles.take(enemy.x, enemy.y)
+    saved["level"] = Level(depth, themap, treasures, enemies, analysis,
+                           free_tiles)
+    saved["level"].player_pos = [x, y]
+    return saved
+
+
+# Writing saves on a background thread, so that the game only pays for
+# the snapshot
+class SaveWriter:
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+
+    def submit(self, path, snapshot):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            # Saves still queued are written before the game exits
+            atexit.register(self.flush)
+        self.jobs.put((path, snapshot))
+
+    def run(self):
+        while True:
+            path, snapshot = self.jobs.get()
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(pack_save(snapshot))
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(f"Could not save to {path}: {e}", file=sys.stderr)
+            finally:
+                self.jobs.task_done()
+
+    def flush(self):
+        self.jobs.join()
+
+
+save_writer = SaveWriter()
+
+
+# Saving the game in the background. Headless runs and replays leave the
+# player's saved game alone.
+def save_game(path=SAVE_PATH):
+    if not headless:
+        save_writer.submit(path, snapshot_game())
+
+
+# Loading a saved game, recorded with its contents so that replays do not
+# depend on the file
+def load_game(path=SAVE_PATH):
+    save_writer.flush()
+    try:
+        with open(path, "rb") as f:
+            blob = f.read()
+    except OSError:
+        blob = b""
+    recorder.load(blob)
+    return restore_game(blob)
+
+
+# Restoring the game from a packed save, returning False if it is not one
+def restore_game(blob):
+    global run_seed, current_level, GRID_WIDTH, GRID_HEIGHT, player_hp, \
+        player_max_hp, player_xp, player_level, xp_for_next_level, \
+        stat_points, strength, vitality, player_direction, log, \
+        inventory_open, potion_selection, player_animation_state, \
+        player_current_frame, player_frame_counter, game_state
+
+    try:
+        saved = unpack_save(blob)
+    except (ValueError, struct.error, zlib.error):
+        log.append("No saved game to load!")
+        return False
+
+    run_seed = saved["seed"]
+    current_level = saved["depth"]
+    GRID_WIDTH, GRID_HEIGHT = saved["width"], saved["height"]
+    (_, _, player_hp, player_max_hp, player_xp, player_level,
+     xp_for_next_level, stat_points, strength, vitality,
+     direction) = saved["player"]
+    player_direction = DIRECTIONS[direction]
+    inventory.update(zip(POTIONS, saved["inventory"]))
+    for slot, name in zip(ARMOR_SLOTS, saved["armor"]):
+        # No armor can be found yet, so there are no sprites to restore
+        equipped_armor[slot] = Armor(name, slot, None) if name else None
+    loot_rng.setstate(saved["random"])
+    log = saved["log"]
+    inventory_open = False
+    potion_selection = False
+    player_animation_state = "idle"
+    player_current_frame = 0
+    player_frame_counter = 0
+    game_state = "player_turn"
+
+    level = saved["level"]
+    enter_level(level, saved["explored"])
+    # Awake enemies take their place in the turn order back
+    turn_scheduler.now = saved["now"]
+    turn_scheduler.order = saved["order"]
+    for enemy, (due_time, order) in zip(level.enemies, saved["due"]):
+        if due_time >= 0:
+            dormant_enemies.discard(enemy)
+            turn_scheduler.queue.append((due_time, order, enemy))
+    heapq.heapify(turn_scheduler.queue)
+    log.append("Game loaded!")
+    return True
 
 
 # Handling the player inputs
@@ -838,6 +2147,11 @@ def handle_player_input(event):
         log.append(f"You increased Vitality to {vitality}!")
     elif event.key == pygame.K_e:
         handle_interaction()
+    elif event.key == pygame.K_F5:
+        save_game()
+        log.append("Game saved!")
+    elif event.key == pygame.K_F9:
+        load_game()
     elif event.key == pygame.K_u and not inventory_open:
         if sum(inventory.values()) > 0:
             potion_selection = not potion_selection
@@ -877,17 +2191,17 @@ def handle_player_move(new_x, new_y, dx, dy):
         player_current_frame, player_frame_counter, \
         player_direction
 
-    enemy_in_path = next((e for e in enemies if e["x"] ==
-                          new_x and e["y"] == new_y and
-                          e["animation_state"] != "dying"), None)
-    chest_blocking = any(t['x'] == new_x and t['y'] ==
-                         new_y and t['state'] == 'closed' for t in treasures)
+    enemy_in_path = enemy_at.get((new_x, new_y))
+    chest = chest_at.get((new_x, new_y))
+    chest_blocking = chest is not None and chest['state'] == 'closed'
 
     if (0 <= new_x < GRID_WIDTH and 0 <= new_y < GRID_HEIGHT
-            and map_data[new_y][new_x] in [0, 2] and not chest_blocking):
+            and map_data[new_x, new_y] in [0, 2] and not chest_blocking):
         if enemy_in_path:
             handle_attack(enemy_in_path, dx, dy)
         else:
+            free_tiles.release(player_pos[0], player_pos[1])
+            free_tiles.take(new_x, new_y)
             player_pos[0] = new_x
             player_pos[1] = new_y
             reveal_area(player_pos[0], player_pos[1])
@@ -901,14 +2215,12 @@ def handle_attack(enemy, dx, dy):
         player_hp, player_xp
 
     damage = 5 + strength
-    enemy["health"] -= damage
-    log.append(f"You hit an {enemy['type']} for {damage} damage!")
+    enemy.health -= damage
+    log.append(f"You hit an {enemy.name} for {damage} damage!")
 
     # Trigging goblin damage animation
-    if enemy["type"] == "goblin":
-        enemy["animation_state"] = "damaged"
-        enemy["current_frame"] = 0
-        enemy["frame_counter"] = 0
+    if enemy.kind == GOBLIN:
+        set_enemy_state(enemy, DAMAGED)
 
     player_animation_state = "attacking"
     player_current_frame = 0
@@ -918,23 +2230,22 @@ def handle_attack(enemy, dx, dy):
     player_direction = "right" if dx > 0 else \
         "left" if dx < 0 else "down" if dy > 0 else "up"
 
-    if enemy["health"] <= 0:
-        enemy["animation_state"] = "dying"
-        enemy["current_frame"] = 0
-        enemy["frame_counter"] = 0
+    if enemy.health <= 0:
+        set_enemy_state(enemy, DYING)
+        remove_enemy(enemy)
         xp_gain = (10 + current_level) if (
-                enemy["type"] == "goblin") else (20 + current_level * 2)
+                enemy.kind == GOBLIN) else (20 + current_level * 2)
         player_xp += xp_gain
         log.append(f"Gained {xp_gain} XP!")
         check_level_up()
     else:
-        retaliation_damage = max(MIN_ENEMY_DAMAGE, enemy["damage"] - strength)
+        retaliation_damage = max(MIN_ENEMY_DAMAGE, enemy.damage - strength)
         player_hp -= retaliation_damage
-        log.append(f"The {enemy['type']} "
+        log.append(f"The {enemy.name} "
                    f"retaliates for {retaliation_damage} damage!")
         if player_hp <= 0:
             log.append("You died!")
-            game_over_screen()
+            game_state = "game_over"
             return
 
 
@@ -945,18 +2256,18 @@ def handle_interaction():
     for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1), (0, 0)]:
         check_x = player_pos[0] + dx
         check_y = player_pos[1] + dy
-        for treasure in treasures:
-            if (treasure['x'] == check_x and treasure['y']
-                    == check_y and treasure['state'] == 'closed'):
-                treasure['state'] = 'open'
-                potion_type = random.choices(list
-                                             (POTION_WEIGHTS.keys()),
-                                             weights=list(POTION_WEIGHTS.
-                                                          values()), k=1)[0]
-                inventory[f"{potion_type.capitalize()} Potion"] += 1
-                player_xp += 5
-                log.append(f"Found {potion_type.capitalize()} Potion!")
-                check_level_up()
+        treasure = chest_at.get((check_x, check_y))
+        if treasure is not None and treasure['state'] == 'closed':
+            treasure['state'] = 'open'
+            free_tiles.release(check_x, check_y)
+            potion_type = loot_rng.choices(list
+                                           (POTION_WEIGHTS.keys()),
+                                           weights=list(POTION_WEIGHTS.
+                                                        values()), k=1)[0]
+            inventory[f"{potion_type.capitalize()} Potion"] += 1
+            player_xp += 5
+            log.append(f"Found {potion_type.capitalize()} Potion!")
+            check_level_up()
 
 
 # Potion usage handler
@@ -978,13 +2289,15 @@ def handle_potion_use(key):
 
 # Player animation for attacking
 def handle_player_animation():
-    global player_frame_counter, player_current_frame, game_state
+    global player_frame_counter, player_current_frame, game_state, \
+        player_animation_state
 
     player_frame_counter += 1
     if player_frame_counter >= 3:
         player_current_frame += 1
         player_frame_counter = 0
-        if player_current_frame >= len(attack_right_sprites):
+        if player_current_frame >= animation_lengths[("player",
+                                                      "attacking")]:
             player_animation_state = "idle"
             player_current_frame = 0
             game_state = "enemy_turn"
@@ -998,7 +2311,8 @@ def handle_player_damage_animation():
     if player_frame_counter >= 3:
         player_current_frame += 1
         player_frame_counter = 0
-        if player_current_frame >= len(player_damage_frames):
+        if player_current_frame >= animation_lengths[("player",
+                                                      "damaged")]:
             player_animation_state = "idle"
             player_current_frame = 0
 
@@ -1006,48 +2320,38 @@ def handle_player_damage_animation():
 # Enemy animations
 def handle_enemy_animations():
     animations_done = True
-    for enemy in enemies:
-        if enemy["animation_state"] == "attacking":
-            enemy["frame_counter"] += 1
-            if enemy["frame_counter"] >= 5:
-                enemy["current_frame"] += 1
-                enemy["frame_counter"] = 0
-                if (enemy["current_frame"] >= len
-                    (goblin_attack_sprites if enemy["type"] ==
-                        "goblin" else slime_attack_sprites)):
-                    enemy["animation_state"] = "alive"
-            if enemy["current_frame"] < len(goblin_attack_sprites
-                                            if enemy["type"] == "goblin"
-                                            else slime_attack_sprites):
+    for enemy in list(animating_enemies):
+        if enemy.state == ATTACKING:
+            enemy.frame_counter += 1
+            frame_count = enemy_animation_lengths[enemy.kind][ATTACKING]
+            if enemy.frame_counter >= 5:
+                enemy.current_frame += 1
+                enemy.frame_counter = 0
+                if enemy.current_frame >= frame_count:
+                    set_enemy_state(enemy, ALIVE)
+            if enemy.current_frame < frame_count:
                 animations_done = False
     return animations_done
 
 
 # Main menu screen initialization
 def main_menu():
-    # Load button images
-    start_button = pygame.image.load("buttons/playbutton.png").convert_alpha()
-    quit_button = pygame.image.load("buttons/quitbutton.png").convert_alpha()
-
-    # Resize buttons
-    button_width, button_height = 180, 50  # New button size
-    start_button = pygame.transform.scale(start_button,
-                                          (button_width, button_height))
-    quit_button = pygame.transform.scale(quit_button,
-                                         (button_width, button_height))
-
-    # Load background image and scale it to fit the screen
-    background = pygame.image.load("background.png").convert()
-    background = pygame.transform.scale(background,
-                                        (SCREEN_WIDTH, SCREEN_HEIGHT))
+    # Load button images, resized
+    button_size = (180, 50)  # New button size
+    start_button = load_image("buttons/playbutton.png", button_size)
+    quit_button = load_image("buttons/quitbutton.png", button_size)
+
+    # Load background image scaled to fit the screen
+    background = load_image("background.png",
+                            (SCREEN_WIDTH, SCREEN_HEIGHT), alpha=False)
 
     # Title font
-    title_font = pygame.font.Font(FONT_PATH, 72)
-    subtitle_font = pygame.font.Font(FONT_PATH, 56)
+    title_font = load_font(72)
+    subtitle_font = load_font(56)
 
     # Title text
-    title_text = title_font.render("Rogue-like Game", True, WHITE)
-    subtitle_text = subtitle_font.render("Adventure Awaits!", True, WHITE)
+    title_text = render_text(title_font, "Rogue-like Game", WHITE)
+    subtitle_text = render_text(subtitle_font, "Adventure Awaits!", WHITE)
 
     # Button positions (moved a bit lower)
     start_button_rect = start_button.get_rect(center=(SCREEN_WIDTH //
@@ -1063,9 +2367,9 @@ def main_menu():
 
         # Draw title with shadow
         shadow_offset = 5
-        title_shadow = title_font.render("Rogue-like Game", True, BLACK)
-        subtitle_shadow = subtitle_font.render("Adventure Awaits!",
-                                               True, BLACK)
+        title_shadow = render_text(title_font, "Rogue-like Game", BLACK)
+        subtitle_shadow = render_text(subtitle_font, "Adventure Awaits!",
+                                      BLACK)
         screen.blit(title_shadow, (SCREEN_WIDTH // 2 -
                                    title_text.get_width() // 2 +
                                    shadow_offset, 100 + shadow_offset))
@@ -1080,38 +2384,29 @@ def main_menu():
         # Draw buttons (without borders)
         screen.blit(start_button, start_button_rect)
         screen.blit(quit_button, quit_button_rect)
+        pygame.display.flip()
 
         # Handle events
-        for event in pygame.event.get():
+        for event in wait_for_events():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 mouse_pos = pygame.mouse.get_pos()
                 if start_button_rect.collidepoint(mouse_pos):
-                    restart_game()
                     return
                 elif quit_button_rect.collidepoint(mouse_pos):
                     pygame.quit()
                     sys.exit()
 
-        pygame.display.flip()
-        clock.tick(15)
-
 
 # Options menu initialization
 def options_menu():
     # Function for options menu
-    menu_button = pygame.image.load("buttons/menu.png").convert_alpha()
-    restart_button = pygame.image.load("buttons/"
-                                       "restartbutton.png").convert_alpha()
-
-    # Resize buttons
-    button_width, button_height = 180, 50
-    menu_button = pygame.transform.scale(menu_button,
-                                         (button_width, button_height))
-    restart_button = pygame.transform.scale(restart_button,
-                                            (button_width, button_height))
+    # Load buttons, resized
+    button_size = (180, 50)
+    menu_button = load_image("buttons/menu.png", button_size)
+    restart_button = load_image("buttons/restartbutton.png", button_size)
 
     # Button positions
     menu_button_rect = menu_button.get_rect(center=(SCREEN_WIDTH // 2,
@@ -1122,14 +2417,15 @@ def options_menu():
 
     while True:
         screen.fill(DARK_GRAY)
-        title = options_font.render("Options", True, WHITE)
+        title = render_text(options_font, "Options", WHITE)
         screen.blit(title, (SCREEN_WIDTH // 2 - title.get_width() // 2, 100))
 
         # Draw buttons
         screen.blit(menu_button, menu_button_rect)
         screen.blit(restart_button, restart_button_rect)
+        pygame.display.flip()
 
-        for event in pygame.event.get():
+        for event in wait_for_events():
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
@@ -1141,26 +2437,20 @@ def options_menu():
                 if menu_button_rect.collidepoint(mouse_pos):
                     return "menu"
                 elif restart_button_rect.collidepoint(mouse_pos):
-                    restart_game()
                     return "restart"
 
-        pygame.display.flip()
-        clock.tick(15)
-
 
 # Restarting the game from the begining
-def restart_game():
+def restart_game(seed=None):
     # Function for reseting the game to the original state
-    global player_pos, player_hp, player_max_hp, inventory, \
-        equipped_armor, inventory_open, \
+    global run_seed, loot_rng, player_hp, player_max_hp, \
+        inventory, equipped_armor, inventory_open, \
         potion_selection, player_animation_state, \
         player_current_frame, player_frame_counter, \
         player_direction, player_xp, player_level, \
         xp_for_next_level, current_level, stat_points, \
-        strength, vitality, log, visibility, treasures, \
-        enemies, map_data, staircase_pos, themap
+        strength, vitality, log, game_state
     # Reset player state
-    player_pos = [GRID_WIDTH // 2, GRID_HEIGHT // 2]
     player_hp = 50
     player_max_hp = 50
     inventory = {
@@ -1192,96 +2482,431 @@ def restart_game():
     vitality = 1
     log = []
 
-    # Reset visibility
-    visibility = [[False for _ in range(GRID_WIDTH)]
-                  for _ in range(GRID_HEIGHT)]
+    # Start a new run, from the given seed or a random one
+    run_seed = random.getrandbits(32) if seed is None else seed
+    recorder.restart(run_seed)
+    loot_rng = random.Random(f"{run_seed}:loot")
 
-    # Reset dungeon map
-    themap = Map()
-    themap.makeMap(GRID_WIDTH, GRID_HEIGHT, fail=50, b1=50, mrooms=50)
-    map_data = themap.mapArr
-    staircase_pos = themap.staircase_pos
+    # Build the first dungeon level, dropping any level queued up for the
+    # last run
+    enter_level(level_prefetcher.take(1))
 
-    # Reset player position to the first room
-    first_room = themap.roomList[0]
-    player_pos = [first_room[2] + first_room[0] //
-                  2, first_room[3] + first_room[1] // 2]
 
-    # Reset treasures and enemies
-    treasures = generate_treasures(3)
-    enemies = generate_enemies(5 + current_level)
+# Drawing a full frame of the game
+def draw_frame():
+    update_camera()
+    screen.fill(BLACK)
+    draw_map()
+    draw_objects()
+    draw_ui()
+    if current_level == 3:
+        draw_warg_health_bar()
+    if inventory_open:
+        draw_status_window()
+    if potion_selection:
+        draw_potion_selection()
+
+
+# Describing what is on screen, keyed by element, with its screen rect
+def scene_signature():
+    scene = {}
+    for ident, key, pos in scene_sprites():
+        scene[ident] = (key, pos), pygame.Rect(pos, sprite_atlas[key]
+                                               .get_size())
+
+    scene["hud"] = ((player_hp, player_max_hp, player_xp,
+                     xp_for_next_level, player_level, current_level,
+                     tuple(log[-3:])), HUD_RECT)
+    if current_level == 3:
+        warg = next((e for e in enemies if e.kind == WARG
+                     and e.state != DYING), None)
+        scene["warg_bar"] = (warg and warg.health), WARG_BAR_RECT
+    if inventory_open:
+        scene["status"] = ((player_hp, player_max_hp, player_level,
+                            player_xp, xp_for_next_level, strength,
+                            vitality, stat_points,
+                            tuple(inventory.values()),
+                            tuple(equipped_armor.values())),
+                           STATUS_WINDOW_RECT)
+    if potion_selection:
+        scene["potions"] = (tuple(inventory.values()),
+                            POTION_SELECTION_RECT)
+    return scene
+
+
+# Redrawing and pushing only the regions that changed since last frame
+def present_dirty_rects():
+    global previous_scene, full_redraw
+    update_camera()
+    scene = scene_signature()
+    for ident in previous_scene.keys() | scene.keys():
+        old = previous_scene.get(ident)
+        new = scene.get(ident)
+        if old is None or new is None or old[0] != new[0]:
+            if old is not None:
+                mark_dirty(old[1])
+            if new is not None:
+                mark_dirty(new[1])
+    previous_scene = scene
+
+    if full_redraw:
+        draw_frame()
+        pygame.display.flip()
+        full_redraw = False
+    elif dirty_rects:
+        screen.set_clip(dirty_rects[0].unionall(dirty_rects[1:]))
+        draw_frame()
+        screen.set_clip(None)
+        pygame.display.update(dirty_rects)
+    dirty_rects.clear()
+
+
+# Checking whether anything on screen is still animating
+def is_animating():
+    return (player_animation_state != "idle" or
+            bool(animating_enemies))
+
+
+# Advancing the game by one fixed animation tick
+def update_game():
+    global game_state
+
+    if game_state == "player_animating":
+        handle_player_animation()
+    elif game_state == "enemy_turn":
+        move_enemies()
+        if game_state == "game_over":
+            return
+        if any(e.state == ATTACKING for e in animating_enemies):
+            game_state = "enemy_animating"
+        else:
+            game_state = "player_turn"
+    elif game_state == "enemy_animating":
+        if handle_enemy_animations():
+            game_state = "player_turn"
 
-    # Reveal the starting area
-    reveal_area(player_pos[0], player_pos[1])
+    if player_animation_state == "damaged":
+        handle_player_damage_animation()
+
+    if (player_pos[0] == staircase_pos[0]
+            and player_pos[1] == staircase_pos[1]):
+        generate_new_level()
+
+    advance_enemy_animations()
 
 
 # Main function
-def main():
+def main(seed=None):
     global font, game_state
 
-    # Show the main menu
+    # Show the main menu, then start the run once it is left
     main_menu()
-
-    # Initialize the game state
-    restart_game()
+    restart_game(seed)
 
     # Start the game loop
+    tick_length = 1000 / ANIMATION_TICK_RATE
+    accumulator = 0
     running = True
     while running:
-        for event in pygame.event.get():
+        if game_state == "player_turn" and not is_animating():
+            # Nothing to animate, sleep until the player does something
+            events = wait_for_events()
+            clock.tick()
+            accumulator = tick_length
+        else:
+            events = pygame.event.get()
+
+        for event in events:
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.VIDEOEXPOSE:
+                mark_all_dirty()
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     option = options_menu()
+                    mark_all_dirty()
                     if option == "menu":
                         main_menu()  # Return to the main menu
+                        restart_game()  # and start a new run from it
                     elif option == "restart":
                         restart_game()  # Restart the game
                     elif option == "back":
                         continue  # Continue playing (close the options menu)
                 elif game_state == "player_turn":
+                    recorder.key(event.key)
                     handle_player_input(event)
 
-        if game_state == "player_animating":
-            handle_player_animation()
-        elif game_state == "enemy_turn":
-            move_enemies()
-            if any(e["animation_state"] == "attacking" for e in enemies):
-                game_state = "enemy_animating"
-            else:
-                game_state = "player_turn"
-        elif game_state == "enemy_animating":
-            if handle_enemy_animations():
-                game_state = "player_turn"
+        while accumulator >= tick_length:
+            update_game()
+            accumulator -= tick_length
 
-        if player_animation_state == "damaged":
-            handle_player_damage_animation()
+        if game_state == "game_over":
+            game_over_screen()
+            mark_all_dirty()
 
-        if (player_pos[0] == staircase_pos[0]
-                and player_pos[1] == staircase_pos[1]):
-            generate_new_level()
+        if DIRTY_RECT_RENDERING:
+            present_dirty_rects()
+        else:
+            draw_frame()
+            pygame.display.flip()
 
-        screen.fill(BLACK)
-        draw_map()
-        draw_objects()
-        draw_ui()
-        if current_level == 3:
-            draw_warg_health_bar()
-        if inventory_open:
-            draw_status_window()
-        if potion_selection:
-            draw_potion_selection()
-        pygame.display.flip()
-        clock.tick(15)
+        # Skip ticks lost to menus or a stalled frame rather than
+        # fast-forwarding through them
+        accumulator = min(accumulator + clock.tick(RENDER_FPS),
+                          tick_length * MAX_TICKS_PER_FRAME)
 
     pygame.quit()
     sys.exit()
 
 
-if __name__ == "__main__":
-    pygame.init()
-    font = pygame.font.Font(FONT_PATH, 32)
-    options_font = pygame.font.Font(FONT_PATH, 48)
+# Finishing every running animation at once, used when nothing is drawn
+def finish_animations():
+    global player_animation_state, player_current_frame, \
+        player_frame_counter, game_state
 
-    main()
+    player_animation_state = "idle"
+    player_current_frame = 0
+    player_frame_counter = 0
+    for enemy in list(animating_enemies):
+        if enemy.state == DYING:
+            discard_enemy(enemy)
+        else:
+            set_enemy_state(enemy, ALIVE)
+
+    if game_state == "player_animating":
+        game_state = "enemy_turn"
+    elif game_state == "enemy_animating":
+        game_state = "player_turn"
+
+
+# Resolving the rest of a turn without waiting on animations
+def resolve_turn():
+    while game_state not in ("player_turn", "game_over"):
+        finish_animations()
+        update_game()
+    finish_animations()
+
+
+# Choosing the next key for the scripted headless player
+def headless_policy(rng):
+    if stat_points > 0:
+        return rng.choice([pygame.K_s, pygame.K_v])
+    if potion_selection:
+        for key, potion in [(pygame.K_3, "Large Potion"),
+                            (pygame.K_2, "Medium Potion"),
+                            (pygame.K_1, "Small Potion")]:
+            if inventory[potion] > 0:
+                return key
+    if player_hp < player_max_hp // 3 and sum(inventory.values()) > 0:
+        return pygame.K_u
+    return rng.choice([pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT,
+                       pygame.K_RIGHT, pygame.K_e])
+
+
+# Running the game without a window as fast as the CPU allows
+def run_headless(turns, seed=None):
+    init_display(headless_mode=True)
+    random.seed(seed)
+    policy_rng = random.Random(seed)
+    restart_game(seed)
+
+    deaths = 0
+    deepest_level = current_level
+    start = time.perf_counter()
+    for _ in range(turns):
+        key = headless_policy(policy_rng)
+        recorder.key(key)
+        handle_player_input(pygame.event.Event(pygame.KEYDOWN, key=key))
+        resolve_turn()
+        deepest_level = max(deepest_level, current_level)
+        if game_state == "game_over":
+            deaths += 1
+            restart_game()
+    elapsed = time.perf_counter() - start
+
+    print(f"{turns} turns in {elapsed:.2f}s "
+          f"({turns / max(elapsed, 1e-9):.0f} turns/s), "
+          f"deepest level {deepest_level}, {deaths} deaths")
+
+
+# Recorded sessions: a header, then one byte per turn naming its key,
+# with the seed of every new run, every loaded game and a state hash
+# every so many turns in between
+RECORDING_MAGIC = b"DCRC"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<HHHHH")
+RECORDED_KEYS = [pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT,
+                 pygame.K_e, pygame.K_i, pygame.K_u, pygame.K_1, pygame.K_2,
+                 pygame.K_3, pygame.K_s, pygame.K_v, pygame.K_F5]
+RECORD_RESTART = 0xFF
+RECORD_LOAD = 0xFE
+RECORD_HASH = 0xFD
+RECORD_HASH_INTERVAL = 100
+
+
+# A short digest of everything the turns change, for checking replays
+def state_hash():
+    state = (run_seed, current_level, tuple(player_pos), player_hp,
+             player_max_hp, player_xp, player_level, stat_points, strength,
+             vitality, sorted(inventory.items()), inventory_open,
+             potion_selection, len(log),
+             [(e.kind, e.x, e.y, e.health) for e in enemies
+              if e.state != DYING],
+             [t["state"] for t in treasures])
+    return hashlib.blake2b(repr(state).encode(), digest_size=8).digest()
+
+
+# Writing the keys of a session to a file as they are played
+class InputRecorder:
+    def __init__(self):
+        self.file = None
+        self.turns = 0
+        self.hash_interval = 0
+
+    def start(self, path, hash_interval=RECORD_HASH_INTERVAL):
+        self.file = open(path, "wb")
+        self.hash_interval = hash_interval
+        self.file.write(RECORDING_MAGIC + RECORDING_HEADER.pack(
+            RECORDING_VERSION, GRID_WIDTH, GRID_HEIGHT, FOV_RADIUS,
+            ENEMY_WAKE_RADIUS))
+        atexit.register(self.file.close)
+
+    # Keys that do nothing in the game are left out
+    def key(self, key):
+        if self.file is None or key not in RECORDED_KEYS:
+            return
+        if self.hash_interval and self.turns % self.hash_interval == 0:
+            self.file.write(bytes([RECORD_HASH]) + state_hash())
+        self.file.write(bytes([RECORDED_KEYS.index(key)]))
+        self.turns += 1
+
+    def restart(self, seed):
+        if self.file is not None:
+            self.file.write(bytes([RECORD_RESTART]) + struct.pack("<I", seed))
+
+    def load(self, blob):
+        if self.file is not None:
+            self.file.write(bytes([RECORD_LOAD])
+                            + struct.pack("<I", len(blob)) + blob)
+
+
+recorder = InputRecorder()
+
+
+# Playing a recorded session back without a window as fast as the CPU
+# allows, checking the recorded state hashes if asked to. Returns False
+# on the first hash that does not match.
+def run_replay(path, verify=False):
+    global GRID_WIDTH, GRID_HEIGHT, FOV_RADIUS, ENEMY_WAKE_RADIUS
+
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != RECORDING_MAGIC:
+        raise ValueError(f"{path} is not a recording")
+    (version, GRID_WIDTH, GRID_HEIGHT, FOV_RADIUS,
+     ENEMY_WAKE_RADIUS) = RECORDING_HEADER.unpack_from(data, 4)
+    if version != RECORDING_VERSION:
+        raise ValueError(f"recording version {version}")
+    init_display(headless_mode=True)
+
+    turns = 0
+    checked = 0
+    offset = 4 + RECORDING_HEADER.size
+    start = time.perf_counter()
+    while offset < len(data):
+        record = data[offset]
+        offset += 1
+        if record == RECORD_RESTART:
+            seed, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            restart_game(seed)
+        elif record == RECORD_LOAD:
+            size, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            restore_game(data[offset:offset + size])
+            offset += size
+        elif record == RECORD_HASH:
+            if verify:
+                if data[offset:offset + 8] != state_hash():
+                    print(f"state hash mismatch before turn {turns}",
+                          file=sys.stderr)
+                    return False
+                checked += 1
+            offset += 8
+        else:
+            key = RECORDED_KEYS[record]
+            handle_player_input(pygame.event.Event(pygame.KEYDOWN, key=key))
+            resolve_turn()
+            turns += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"{turns} turns replayed in {elapsed:.2f}s "
+          f"({turns / max(elapsed, 1e-9):.0f} turns/s), "
+          f"{checked} state hashes checked")
+    return True
+
+
+# Parsing a WIDTHxHEIGHT map size argument
+def parse_map_size(text):
+    try:
+        width, height = (int(n) for n in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WxH, got {text!r}")
+    if width < VIEW_WIDTH or height < VIEW_HEIGHT:
+        raise argparse.ArgumentTypeError(
+            f"map must be at least {VIEW_WIDTH}x{VIEW_HEIGHT}")
+    return width, height
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rogue-like Game")
+    parser.add_argument("--headless", action="store_true",
+                        help="simulate turns without a window or drawing")
+    parser.add_argument("--turns", type=int, default=10000,
+                        help="number of turns to simulate when headless")
+    parser.add_argument("--seed", type=int,
+                        help="dungeon seed of the first run")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="redraw and push only changed screen regions")
+    parser.add_argument("--fov-radius", type=int, default=FOV_RADIUS,
+                        help="sight radius of the player in tiles")
+    parser.add_argument("--map-size", type=parse_map_size,
+                        default=(GRID_WIDTH, GRID_HEIGHT), metavar="WxH",
+                        help="dungeon size in tiles, e.g. 200x200")
+    parser.add_argument("--level-cache", action="store_true",
+                        help=f"keep generated levels in {LEVEL_CACHE_DIR}/")
+    parser.add_argument("--wake-radius", type=int, default=ENEMY_WAKE_RADIUS,
+                        help="distance in tiles within which enemies wake")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the seeds and keys of the session")
+    parser.add_argument("--hash-every", type=int, metavar="N",
+                        default=RECORD_HASH_INTERVAL,
+                        help="turns between state hashes in a recording, "
+                             "0 for none")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay a recorded session without a window")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the state hashes while replaying")
+    args = parser.parse_args()
+    GRID_WIDTH, GRID_HEIGHT = args.map_size
+    FOV_RADIUS = args.fov_radius
+    ENEMY_WAKE_RADIUS = args.wake_radius
+    if args.level_cache:
+        level_cache_dir = LEVEL_CACHE_DIR
+
+    if args.replay:
+        try:
+            replayed = run_replay(args.replay, args.verify)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        sys.exit(0 if replayed else 1)
+    if args.record:
+        recorder.start(args.record, args.hash_every)
+
+    if args.headless:
+        run_headless(args.turns, args.seed)
+    else:
+        if args.dirty_rects:
+            DIRTY_RECT_RENDERING = True
+        init_display()
+        main(args.seed)
@@ -0,0 +1,370 @@
+'''
+    File name: benchmark.py
+    Benchmarks for DungeonCrawler.py, run from the game directory:
+
+        python benchmark.py startup
+        python benchmark.py generation
+        python benchmark.py suite --output results.json
+        python benchmark.py suite --compare results.json
+'''
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+GAME_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Marks the line with the timings of startup-child, apart from anything
+# else the game or its level prefetch worker prints
+STARTUP_MARKER = "startup-timings"
+
+
+# Timing game import to first rendered frame inside a fresh interpreter,
+# leaving out the fixed cost of importing pygame itself. The first frame
+# includes starting the level prefetch worker, as for a player.
+def startup_child(cache_path):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    start = time.perf_counter()
+    import DungeonCrawler as game
+
+    game.assets.cache_path = cache_path
+    game.init_display()
+    game.restart_game()
+    game.draw_frame()
+    pygame.display.flip()
+    first_frame = time.perf_counter() - start
+
+    # Every remaining sprite, as needed by later levels and menus
+    start = time.perf_counter()
+    for entity, state in game.SPRITE_ANIMATIONS:
+        game.sprite_atlas[(entity, state, 0, "right")]
+    game.load_image("background.png",
+                    (game.SCREEN_WIDTH, game.SCREEN_HEIGHT), alpha=False)
+    print(STARTUP_MARKER, first_frame, time.perf_counter() - start)
+
+
+# Running one startup in a child process,
+# returning (wall, first frame, remaining assets)
+def time_startup(cache_path):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.abspath(__file__),
+                             "startup-child", cache_path],
+                            cwd=GAME_DIR, capture_output=True, text=True,
+                            check=True,
+                            env=dict(os.environ,
+                                     PYGAME_HIDE_SUPPORT_PROMPT="1"))
+    wall = time.perf_counter() - start
+    for line in result.stdout.splitlines():
+        if line.startswith(STARTUP_MARKER):
+            first_frame, remaining = line.split()[1:]
+            break
+    else:
+        raise RuntimeError(f"no timings from startup-child:\n"
+                           f"{result.stdout}")
+    return wall, float(first_frame), float(remaining)
+
+
+# Dungeon generation time across grid sizes and room placement attempts
+GENERATION_CASES = [((37, 18), 50), ((100, 100), 500), ((300, 300), 3000),
+                    ((1000, 1000), 20000)]
+
+
+def bench_generation(runs):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import DungeonCrawler as game
+
+    for (width, height), attempts in GENERATION_CASES:
+        times = []
+        for seed in range(runs):
+            random.seed(seed)
+            themap = game.Map()
+            start = time.perf_counter()
+            themap.makeMap(width, height, 50, 50, attempts)
+            times.append(time.perf_counter() - start)
+        print(f"generation {width}x{height}, {attempts} attempts: "
+              f"{statistics.median(times) * 1000:.1f} ms, "
+              f"{len(themap.roomList)} rooms")
+
+
+# Hot paths of the game timed per call, across grid sizes and enemy counts
+SUITE_SIZES = [(37, 18), (100, 100), (300, 300)]
+SUITE_ENEMIES = [10, 100, 1000]
+SUITE_SEED = 1234
+
+
+# Seconds per call of func, median over a few timed repeats
+def time_call(func, repeat=3):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return statistics.median(timer.repeat(repeat, number)) / number
+
+
+# Seconds per call of a func that changes what it runs on, median over
+# single calls with setup building the same fixture again before each,
+# for at least the given number of calls and seconds
+def time_fresh(func, setup, repeat=5, budget=0.5):
+    times = []
+    end = time.perf_counter() + budget
+    while len(times) < repeat or time.perf_counter() < end:
+        setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# A level of the given size with the display set up for offscreen drawing
+def suite_level(game, width, height):
+    game.GRID_WIDTH, game.GRID_HEIGHT = width, height
+    game.restart_game(SUITE_SEED)
+    game.player_hp = game.player_max_hp = 10 ** 9
+    game.update_camera()
+    game.draw_map()
+
+
+# A floor tile next to the player that the player can step onto
+def free_neighbour(game):
+    x, y = game.player_pos
+    taken = {(e.x, e.y) for e in game.enemies}
+    taken.update((t["x"], t["y"]) for t in game.treasures)
+    for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+        if (game.map_data[x + dx, y + dy] != 1
+                and (x + dx, y + dy) not in taken):
+            return dx, dy
+    return None
+
+
+# A copy of the level's free tiles, so that spawning again and again in
+# a timing loop never runs out of room. The copy is part of the timing.
+def spare_free_tiles(game):
+    free_tiles = copy.copy(game.free_tiles)
+    free_tiles.free = bytearray(free_tiles.free)
+    return free_tiles
+
+
+# Playing on a copy of a saved board, so that every timed turn starts
+# from the same enemy positions
+def enter_board(game, board):
+    game.enter_level(copy.deepcopy(board))
+    game.player_hp = game.player_max_hp = 10 ** 9
+    game.dirty_rects.clear()
+
+
+def run_suite(sizes, enemy_counts):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    import pygame
+    import DungeonCrawler as game
+
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    game.screen = pygame.Surface((game.SCREEN_WIDTH, game.SCREEN_HEIGHT))
+    game.load_tiles()
+    results = {}
+
+    # Timing func, which makes the given number of calls of the benchmark,
+    # on a fresh fixture from setup each time if given
+    def record(name, func, calls=1, setup=None):
+        if setup is None:
+            results[name] = time_call(func) / calls
+        else:
+            results[name] = time_fresh(func, setup) / calls
+        print(f"{name:45} {results[name] * 1e6:12.1f} us", file=sys.stderr)
+
+    for width, height in sizes:
+        size = f"{width}x{height}"
+        rng = random.Random(SUITE_SEED)
+        rooms = game.room_attempts(50, width, height)
+        record(f"make_map[{size}]",
+               lambda: game.Map().makeMap(width, height, 50, 50, rooms, rng))
+
+        suite_level(game, width, height)
+        record(f"generate_treasures[{size}]",
+               lambda: game.generate_treasures(game.themap, 5,
+                                               game.level_analysis,
+                                               spare_free_tiles(game), rng))
+        record(f"level_analysis[{size}]",
+               lambda: game.LevelAnalysis.of(game.map_data,
+                                             game.player_pos))
+
+        # Stepping back and forth recomputes the view every call
+        x, y = game.player_pos
+        step = free_neighbour(game)
+        if step is not None:
+            def reveal():
+                game.reveal_area(x, y)
+                game.reveal_area(x + step[0], y + step[1])
+                game.dirty_rects.clear()
+            record(f"reveal_area[{size}]", reveal, calls=2)
+
+        for count in enemy_counts:
+            case = f"{size},{count} enemies"
+            game.restart_game(SUITE_SEED)
+            game.player_hp = game.player_max_hp = 10 ** 9
+            record(f"generate_enemies[{case}]",
+                   lambda: game.generate_enemies(spare_free_tiles(game),
+                                                 count, 2,
+                                                 game.level_analysis, rng))
+            game.enemies = game.generate_enemies(game.free_tiles, count, 2,
+                                                 game.level_analysis, rng)
+            game.index_entities()
+            game.update_camera()
+            game.draw_map()
+            # The board before any enemy turn, for the cases that move them
+            board = copy.deepcopy(game.Level(
+                1, game.themap, game.treasures, game.enemies,
+                game.level_analysis, game.free_tiles))
+
+            step = free_neighbour(game)
+            if step is not None:
+                def move():
+                    x, y = game.player_pos
+                    game.handle_player_move(x + step[0], y + step[1], *step)
+                    x, y = game.player_pos
+                    game.handle_player_move(x - step[0], y - step[1],
+                                            -step[0], -step[1])
+                    game.dirty_rects.clear()
+                record(f"handle_player_move[{case}]", move, calls=2)
+
+            record(f"draw_map[{case}]", game.draw_map)
+            record(f"draw_objects[{case}]", game.draw_objects)
+
+            # Spawns are out of sight, so every enemy sleeps through these
+            wake_radius = game.ENEMY_WAKE_RADIUS
+            record(f"move_enemies_dormant[{case}]", game.move_enemies,
+                   setup=lambda: enter_board(game, board))
+
+            # The whole swarm awake, as on a fully explored level, timed
+            # on the turn after the one that wakes it
+            def wake_swarm():
+                enter_board(game, board)
+                explored = game.fov.explored.bits
+                explored[:] = b"\xff" * len(explored)
+                game.move_enemies()
+            game.ENEMY_WAKE_RADIUS = max(width, height)
+            record(f"move_enemies[{case}]", game.move_enemies,
+                   setup=wake_swarm)
+            game.ENEMY_WAKE_RADIUS = wake_radius
+    return results
+
+
+# Comparing a run against a saved baseline, returning the regressions
+def compare_results(baseline, results, threshold):
+    regressions = []
+    print(f"{'benchmark':45} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:45} {'-':>12} {seconds * 1e6:10.1f}us")
+            continue
+        change = seconds / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  slower"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:45} {before * 1e6:10.1f}us {seconds * 1e6:10.1f}us "
+              f"{change:+8.1%}{flag}")
+    return regressions
+
+
+def bench_suite(args):
+    sizes = args.sizes or SUITE_SIZES
+    enemy_counts = args.enemies or SUITE_ENEMIES
+    results = run_suite(sizes, enemy_counts)
+
+    if args.output:
+        import pygame
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "pygame": pygame.version.ver,
+                       "platform": platform.platform(),
+                       "unit": "seconds per call",
+                       "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare_results(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+# Parsing a list of WIDTHxHEIGHT sizes
+def size_list(text):
+    try:
+        return [tuple(int(n) for n in size.split("x"))
+                for size in text.lower().split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WxH,..., got {text!r}")
+
+
+# Time-to-first-frame with an empty and with a filled asset cache
+def bench_startup(runs):
+    cold = []
+    warm = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "assets.cache")
+        for _ in range(runs):
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            cold.append(time_startup(cache_path))
+            warm.append(time_startup(cache_path))
+
+    for name, samples in [("cold", cold), ("warm", warm)]:
+        wall = statistics.median(s[0] for s in samples)
+        first_frame = statistics.median(s[1] for s in samples)
+        remaining = statistics.median(s[2] for s in samples)
+        print(f"startup {name}: time-to-first-frame "
+              f"{first_frame * 1000:.1f} ms (with the prefetch worker "
+              f"started), remaining assets "
+              f"{remaining * 1000:.1f} ms "
+              f"(process wall {wall * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DungeonCrawler benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    startup = subparsers.add_parser("startup",
+                                    help="time-to-first-frame, cold and "
+                                         "warm asset cache")
+    startup.add_argument("--runs", type=int, default=5)
+    generation = subparsers.add_parser("generation",
+                                       help="dungeon generation time by "
+                                            "grid size and room count")
+    generation.add_argument("--runs", type=int, default=5)
+    suite = subparsers.add_parser("suite",
+                                  help="per-call timings of the game's hot "
+                                       "paths, with an optional baseline")
+    suite.add_argument("--sizes", type=size_list,
+                       help="grid sizes, e.g. 37x18,100x100")
+    suite.add_argument("--enemies", type=lambda text: [
+                           int(n) for n in text.split(",")],
+                       help="enemy counts, e.g. 10,100")
+    suite.add_argument("--output", help="write the results as JSON")
+    suite.add_argument("--compare", metavar="BASELINE",
+                       help="compare against a saved results file and exit "
+                            "with status 1 on regressions")
+    suite.add_argument("--threshold", type=float, default=0.1,
+                       help="relative slowdown counted as a regression")
+    child = subparsers.add_parser("startup-child")
+    child.add_argument("cache_path")
+    args = parser.parse_args()
+
+    if args.command == "startup":
+        bench_startup(args.runs)
+    elif args.command == "generation":
+        bench_generation(args.runs)
+    elif args.command == "suite":
+        bench_suite(args)
+    elif args.command == "startup-child":
+        startup_child(args.cache_path)
@@ -0,0 +1,120 @@
+'''
+    File name: dungeon_batch.py
+    Generates dungeons in parallel without a display and writes one JSON
+    line of layout statistics per map, for tuning Map.makeMap:
+
+        python dungeon_batch.py --count 10000 --rooms 20,50 --fail 25,50
+'''
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import DungeonCrawler as game  # noqa: E402
+
+
+# Generating one map and measuring its layout
+def layout_stats(job):
+    seed, index, width, height, rooms, fail, b1 = job
+    rng = random.Random(f"{seed}:{index}")
+    start = time.perf_counter()
+    themap = game.Map()
+    themap.makeMap(width, height, fail, b1, rooms, rng)
+    elapsed = time.perf_counter() - start
+
+    tiles = themap.mapArr
+    area = width * height
+    floor = area - tiles.cells.count(1)
+    room_area = sum(room[0] * room[1] for room in themap.roomList)
+    first_room = themap.roomList[0]
+    distances = game.distance_field(tiles,
+                                    first_room[2] + first_room[0] // 2,
+                                    first_room[3] + first_room[1] // 2)
+    stair_x, stair_y = themap.staircase_pos
+
+    return {
+        "seed": seed,
+        "index": index,
+        "width": width,
+        "height": height,
+        "mrooms": rooms,
+        "fail": fail,
+        "b1": b1,
+        "rooms": len(themap.roomList),
+        "floor_ratio": round(floor / area, 4),
+        "corridor_length": floor - room_area,
+        "staircase_distance": distances[stair_y * width + stair_x],
+        "generation_ms": round(elapsed * 1000, 3)
+    }
+
+
+# Parsing a comma separated list of integers, for parameter sweeps
+def int_list(text):
+    try:
+        return [int(n) for n in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected integers, got {text!r}")
+
+
+# A parameter sweep that needs at least one of something, as makeMap
+# places no rooms otherwise
+def positive_list(text):
+    values = int_list(text)
+    if min(values) < 1:
+        raise argparse.ArgumentTypeError(f"expected values of 1 or more, "
+                                         f"got {text!r}")
+    return values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch dungeon generator")
+    parser.add_argument("--count", type=int, default=1000,
+                        help="maps per parameter combination")
+    parser.add_argument("--map-size", type=game.parse_map_size,
+                        default=(game.GRID_WIDTH, game.GRID_HEIGHT),
+                        metavar="WxH")
+    parser.add_argument("--rooms", type=positive_list, default=[50],
+                        help="room placement attempts (mrooms)")
+    parser.add_argument("--fail", type=int_list, default=[50],
+                        help="misses in a row before placement stops")
+    parser.add_argument("--b1", type=int_list, default=[50],
+                        help="percent of corridors going horizontally first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes, 1 to run in this process")
+    parser.add_argument("--output", help="JSONL file, standard output "
+                                         "if not given")
+    args = parser.parse_args()
+
+    width, height = args.map_size
+    combinations = list(itertools.product(args.rooms, args.fail, args.b1))
+    total = len(combinations) * args.count
+    jobs = ((args.seed, index, width, height, rooms, fail, b1)
+            for index, (rooms, fail, b1) in enumerate(
+                combo for combo in combinations
+                for _ in range(args.count)))
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    start = time.perf_counter()
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers)
+        chunksize = max(1, min(64, total // (args.workers * 8)))
+        results = executor.map(layout_stats, jobs, chunksize=chunksize)
+    else:
+        executor = None
+        results = map(layout_stats, jobs)
+    for stats in results:
+        output.write(json.dumps(stats) + "\n")
+    if executor is not None:
+        executor.shutdown()
+    elapsed = time.perf_counter() - start
+    if output is not sys.stdout:
+        output.close()
+
+    print(f"{total} maps in {elapsed:.2f}s ({total / elapsed:.0f} maps/s) "
+          f"with {args.workers} workers", file=sys.stderr)